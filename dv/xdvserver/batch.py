@@ -0,0 +1,213 @@
+"""\
+Usage: %prog [options] SOURCE_DIR OUTPUT_DIR
+
+  Theme the HTML files in SOURCE_DIR and its subdirectories into OUTPUT_DIR,
+  compiling the theme once and theming the files in a pool of processes.
+  Files that have not changed since the last run with the same compiled theme
+  are skipped.\
+"""
+usage = __doc__
+
+import os
+import sys
+import time
+import fnmatch
+import hashlib
+import multiprocessing
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from optparse import OptionParser
+
+from lxml import etree
+from paste.deploy import loadfilter
+
+from dv.xdvserver import pool
+from dv.xdvserver.filter import XDVMiddleware
+
+MANIFEST = '.xdv-manifest.json'
+
+
+def find_files(source, patterns):
+    """Return the paths, relative to ``source``, of the files below it
+    matching one of the glob ``patterns``
+    """
+    found = []
+    for directory, dirnames, filenames in os.walk(source):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if [p for p in patterns if fnmatch.fnmatch(filename, p)]:
+                path = os.path.join(directory, filename)
+                found.append(os.path.relpath(path, source))
+    return found
+
+
+def file_state(path):
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size]
+
+
+def read_manifest(output):
+    path = os.path.join(output, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    f = open(path)
+    try:
+        return json.load(f)
+    except ValueError:
+        return {} # theme everything again
+    finally:
+        f.close()
+
+
+def write_manifest(output, manifest):
+    path = os.path.join(output, MANIFEST)
+    f = open(path + '.tmp', 'w')
+    try:
+        json.dump(manifest, f, sort_keys=True, indent=1)
+    finally:
+        f.close()
+    if os.path.exists(path):
+        os.remove(path) # Windows won't replace
+    os.rename(path + '.tmp', path)
+
+
+def theme_file(job):
+    """Theme one file in a worker process. Returns the relative path, whether
+    it worked, the time it took and the size of the output (or the error).
+    """
+    source, target, relpath = job
+    start = time.time()
+    f = open(source, 'rb')
+    try:
+        body = f.read()
+    finally:
+        f.close()
+    ok, result = pool._apply(body)
+    if not ok:
+        return relpath, False, time.time() - start, result
+    directory = os.path.dirname(target)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    f = open(target, 'wb')
+    try:
+        f.write(result)
+    finally:
+        f.close()
+    return relpath, True, time.time() - start, len(result)
+
+
+def load_middleware(options):
+    """Return the XDVMiddleware for the command line options
+    """
+    if options.config:
+        config_file = os.path.abspath(options.config)
+        middleware = loadfilter('config:%s' % config_file, name=options.name)(None)
+        if not isinstance(middleware, XDVMiddleware):
+            raise ValueError("%s is not an xdv filter" % (options.name or 'main'))
+        return middleware
+    return XDVMiddleware(None, {},
+            rules=options.rules,
+            theme=options.theme,
+            extra=options.extra,
+            absolute_prefix=options.absolute_prefix,
+            includemode=options.includemode,
+            read_network=options.read_network,
+        )
+
+
+def main():
+    """Called from console script
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option("-r", "--rules", metavar="rules.xml", help="Rules file")
+    parser.add_option("-t", "--theme", metavar="theme.html", help="Theme file")
+    parser.add_option("-e", "--extra", metavar="extra.xsl", help="Extra XSL file")
+    parser.add_option("-a", "--absolute-prefix", metavar="/", dest="absolute_prefix",
+                      help="Prefix for relative URLs in the theme")
+    parser.add_option("-i", "--includemode", metavar="INC", default='document',
+                      help="include mode: document, ssi or esi (default: document)")
+    parser.add_option("--network", action="store_true", dest="read_network", default=False,
+                      help="Allow reads from the network")
+    parser.add_option("-c", "--config", metavar="CONFIG_FILE",
+                      help="Take the theme from an xdv filter in a Paste Deploy file instead")
+    parser.add_option("-n", "--name", help="Name of the filter in CONFIG_FILE")
+    parser.add_option("-p", "--pattern", action="append", dest="patterns", default=[],
+                      help="Glob pattern of the files to theme (default: *.html, *.htm)")
+    parser.add_option("-j", "--processes", type="int", default=None,
+                      help="Number of worker processes (default: one per CPU)")
+    parser.add_option("-f", "--force", action="store_true", default=False,
+                      help="Theme all files, even those that have not changed")
+    parser.add_option("-q", "--quiet", action="store_true", default=False,
+                      help="Only report the totals")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error("Wrong number of arguments.")
+    if not options.config and not options.rules:
+        parser.error("Give the rules, or a config file with an xdv filter.")
+    source, output = [os.path.abspath(arg) for arg in args]
+    patterns = options.patterns or ['*.html', '*.htm']
+
+    start = time.time()
+    middleware = load_middleware(options)
+    stylesheet = etree.tostring(middleware.compiled_theme())
+    version = hashlib.sha1(stylesheet).hexdigest()[:12]
+    compile_time = time.time() - start
+
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    manifest = read_manifest(output)
+    jobs = []
+    skipped = 0
+    for relpath in find_files(source, patterns):
+        target = os.path.join(output, relpath)
+        entry = manifest.get(relpath)
+        if (not options.force and entry is not None and os.path.exists(target) and
+                entry['version'] == version and entry['source'] == file_state(os.path.join(source, relpath))):
+            skipped += 1
+            continue
+        jobs.append((os.path.join(source, relpath), target, relpath))
+
+    start = time.time()
+    themed = failed = 0
+    size = 0
+    if jobs:
+        workers = multiprocessing.Pool(options.processes, pool._initialize,
+                                       (stylesheet, bool(options.read_network)))
+        try:
+            for relpath, ok, elapsed, result in workers.imap_unordered(theme_file, jobs):
+                if not ok:
+                    failed += 1
+                    sys.stderr.write("%s: %s\n" % (relpath, result))
+                    continue
+                themed += 1
+                size += result
+                manifest[relpath] = {
+                    'source': file_state(os.path.join(source, relpath)),
+                    'version': version,
+                }
+                if not options.quiet:
+                    print("%s: %d bytes in %.1f ms" % (relpath, result, elapsed * 1000))
+        finally:
+            workers.close()
+            workers.join()
+            write_manifest(output, manifest)
+    elapsed = time.time() - start
+
+    print("Compiled the theme (%s) in %.2f s" % (version, compile_time))
+    print("Themed %d files (%.1f MB) in %.2f s: %.1f files/s, %.1f MB/s; "
+          "%d unchanged, %d failed" % (themed, size / 1048576.0, elapsed,
+          elapsed and themed / elapsed or 0, elapsed and size / 1048576.0 / elapsed or 0,
+          skipped, failed))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
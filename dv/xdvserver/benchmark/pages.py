@@ -0,0 +1,102 @@
+"""Generated content pages, shaped like those of a CMS, for the rules in this
+directory to theme
+"""
+
+import random
+
+HEAD = """<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" lang="en">
+<head>
+<meta http-equiv="Content-Type" content="text/html; charset=utf-8" />
+<title>Benchmark page of %(size)d bytes</title>
+<link rel="stylesheet" type="text/css" href="/portal_css/base.css" />
+<link rel="stylesheet" type="text/css" href="/portal_css/public.css" />
+<style type="text/css">.hiddenStructure { display: none; }</style>
+<script type="text/javascript" src="/portal_javascripts/jquery.js"></script>
+</head>
+<body>
+<div id="portal-top">
+<p class="hiddenStructure"><a href="#documentContent">Skip to content.</a></p>
+<ul id="portal-globalnav">
+%(navigation)s
+</ul>
+</div>
+<div id="portal-breadcrumbs">
+<span id="breadcrumbs-you-are-here">You are here:</span>
+<a href="/">Home</a> <span class="breadcrumbSeparator">&rarr;</span>
+<a href="/news">News</a>
+</div>
+<div id="portal-column-one">
+%(portlets)s
+</div>
+<div id="content">
+<dl class="portalMessage info"><dt>Info</dt><dd>Changes saved.</dd></dl>
+<div class="documentActions"><a href="javascript:print()">Print</a> <a href="/sendto">Send this</a></div>
+<h1 class="documentFirstHeading">Benchmark page</h1>
+<div class="byline"><span class="documentAuthor">by <a href="/author/admin">admin</a></span>
+<span class="discreet">last modified today</span></div>
+"""
+
+ARTICLE = """<div class="article" id="article-%(number)d">
+<h2><a href="/news/item-%(number)d">News item %(number)d</a></h2>
+<p class="documentDescription">%(description)s</p>
+<p>%(text)s <a href="/news/item-%(number)d" class="link-plain">Read more&hellip;</a></p>
+<p>%(text)s &amp; <em>%(emphasis)s</em> &mdash; caf&eacute; &copy; 2010.</p>
+<div class="visualClear"><!-- --></div>
+</div>
+"""
+
+FOOT = """<div class="discussion"><h3>Comments</h3><p>No comments yet.</p></div>
+<p class="visualNoPrint"><a href="#portal-top">Back to top</a></p>
+</div>
+<div id="portal-footer">
+<p>Powered by a content management system. <a href="/accessibility">Accessibility</a></p>
+</div>
+</body>
+</html>
+"""
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+         "tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam "
+         "quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo").split()
+
+
+def sentence(generator, words):
+    return ' '.join([generator.choice(WORDS) for i in range(words)]).capitalize() + '.'
+
+
+def parse_size(value):
+    """Parse a size such as ``5000``, ``50k`` or ``5m`` into a number of bytes
+    """
+    value = value.strip().lower()
+    for suffix, factor in (('k', 1024), ('m', 1024 * 1024)):
+        if value.endswith(suffix):
+            return int(float(value[:-len(suffix)]) * factor)
+    return int(value)
+
+
+def content_page(size, seed=0):
+    """Return a content page of about ``size`` bytes. Pages of the same size
+    and seed are identical.
+    """
+    generator = random.Random(seed)
+    navigation = '\n'.join(['<li id="portaltab-%d"><a href="/section-%d">Section %d</a></li>' % (i, i, i)
+                            for i in range(8)])
+    portlets = '\n'.join(['<dl class="portlet"><dt class="portletHeader">Portlet %d</dt>'
+                          '<dd class="portletItem">%s</dd></dl>' % (i, sentence(generator, 12))
+                          for i in range(4)])
+    parts = [HEAD % {'size': size, 'navigation': navigation, 'portlets': portlets}]
+    length = len(parts[0]) + len(FOOT)
+    number = 0
+    while length < size:
+        article = ARTICLE % {
+            'number': number,
+            'description': sentence(generator, 15),
+            'text': sentence(generator, 40),
+            'emphasis': sentence(generator, 3),
+        }
+        parts.append(article)
+        length += len(article)
+        number += 1
+    parts.append(FOOT)
+    return ''.join(parts)
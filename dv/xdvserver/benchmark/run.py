@@ -0,0 +1,372 @@
+"""\
+Usage: %prog [options]
+
+  Benchmark theming generated content pages of several sizes with the themes
+  and rules bundled in dv.xdvserver.benchmark, single threaded and
+  concurrently, and write the results as JSON.\
+"""
+usage = __doc__
+
+import sys
+import time
+import platform
+import threading
+import traceback
+import multiprocessing
+import pkg_resources
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import resource
+except ImportError:
+    resource = None # not on Windows
+
+from optparse import OptionParser
+
+from lxml import etree
+
+from dv.xdvserver.benchmark.pages import content_page, parse_size
+from dv.xdvserver.filter import XDVMiddleware, XSLTMiddleware
+from dv.xdvserver.stats import Histogram
+
+DEFAULT_SIZES = '5k,50k,500k,5m'
+
+# The rule sets, and whether they use CSS selectors
+RULES = {
+    'xpath': ('rules-xpath.xml', False),
+    'css': ('rules-css.xml', True),
+    'heavy': ('rules-heavy.xml', True),
+    'large-theme': ('rules-css.xml', True),
+}
+
+# The theme of each rule set, if not theme.html
+THEMES = {
+    'large-theme': 'theme-large.html',
+}
+
+# Filter and compiler options whose effect on speed the XDVMiddleware
+# docstring mentions. XInclude is left on: without it the rules it pulls in
+# are missing, and it only takes time when the theme is compiled.
+VARIANTS = {
+    'default': {},
+    'no-css': {'css': False},
+    'update': {'update': True},
+    'skeleton': {'skeleton': True},
+}
+
+IDENTITY = """\
+<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+    <xsl:output method="html" />
+    <xsl:template match="@*|node()">
+        <xsl:copy><xsl:apply-templates select="@*|node()" /></xsl:copy>
+    </xsl:template>
+</xsl:stylesheet>
+"""
+
+
+def data_file(name):
+    return pkg_resources.resource_filename('dv.xdvserver.benchmark', name)
+
+
+def max_rss():
+    """Return the peak resident set size of this process in kilobytes. Each
+    scenario runs in a process of its own, so this is its own peak.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss // 1024 # bytes there
+    return rss
+
+
+def content_app(page):
+    """A stand-in for the themed application, serving ``page`` for any path
+    """
+    headers = [('Content-Type', 'text/html; charset=utf-8'),
+               ('Content-Length', str(len(page)))]
+    def app(environ, start_response):
+        start_response('200 OK', list(headers))
+        return [page]
+    return app
+
+
+def request_environ():
+    return {
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': '/news/item',
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'localhost',
+        'wsgi.url_scheme': 'http',
+        'wsgi.version': (1, 0),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+
+def request(middleware):
+    """Theme one page, reading the whole response. Returns its size.
+    """
+    status = []
+    def start_response(s, headers, exc_info=None):
+        status.append(s)
+    body = middleware(request_environ(), start_response)
+    try:
+        size = sum([len(chunk) for chunk in body])
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    if not status[0].startswith('200'):
+        raise ValueError("Unexpected response: %s" % status[0])
+    return size
+
+
+def measure(middleware, requests, threads):
+    """Send ``requests`` requests from ``threads`` threads and return the
+    requests per second and the latency histogram, in milliseconds
+    """
+    latency = Histogram(size=requests)
+    remaining = [requests]
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            finally:
+                lock.release()
+            start = time.time()
+            try:
+                request(middleware)
+            except Exception as e:
+                errors.append(e)
+                return
+            latency.record((time.time() - start) * 1000)
+
+    start = time.time()
+    if threads == 1:
+        worker()
+    else:
+        workers = [threading.Thread(target=worker) for i in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    elapsed = time.time() - start
+    if errors:
+        raise errors[0]
+    return requests / elapsed, latency.snapshot()
+
+
+def xdv_middleware(app, rules, variant, options):
+    """Return the middleware for a rule set and variant, and how long the
+    theme took to compile in seconds
+    """
+    conf = dict(options)
+    conf.update(VARIANTS[variant])
+    middleware = XDVMiddleware(app, {},
+            rules=data_file(RULES[rules][0]),
+            theme=data_file(THEMES.get(rules, 'theme.html')),
+            **conf
+        )
+    compile_time = None
+    for i in range(3):
+        start = time.time()
+        middleware.compile_theme()
+        elapsed = time.time() - start
+        if compile_time is None or elapsed < compile_time:
+            compile_time = elapsed
+    transform = middleware.first_transform()
+    return middleware, transform, compile_time
+
+
+def identity_middleware(app, options):
+    code = XSLTMiddleware.__init__.__code__
+    accepted = code.co_varnames[:code.co_argcount]
+    options = dict([(name, value) for name, value in options.items() if name in accepted])
+    middleware = XSLTMiddleware(app, {}, xslt_source=IDENTITY, **options)
+    return middleware, middleware, None
+
+
+def scenarios(rules_names, variant_names):
+    """Yield the (rules, variant) pairs to run. The identity transform is a
+    baseline for the cost of parsing and serializing.
+    """
+    yield 'identity', 'default'
+    for rules in rules_names:
+        for variant in variant_names:
+            if variant == 'no-css' and RULES[rules][1]:
+                continue # these rules need CSS support
+            yield rules, variant
+
+
+def run_scenario(size, rules, variant, threads, requests, options):
+    """Run one scenario in this process and return its result
+    """
+    page = content_page(size)
+    app = content_app(page)
+    if rules == 'identity':
+        middleware, transform, compile_time = identity_middleware(app, options)
+    else:
+        middleware, transform, compile_time = xdv_middleware(app, rules, variant, options)
+    try:
+        output_size = request(middleware) # warm up
+        rate, latency = measure(middleware, requests, threads)
+    finally:
+        if rules == 'identity':
+            middleware.close()
+        else:
+            middleware.release()
+    return {
+        'name': '%s/%s/%d/%d' % (rules, variant, size, threads),
+        'rules': rules,
+        'variant': variant,
+        'size': len(page),
+        'output_size': output_size,
+        'threads': threads,
+        'requests': requests,
+        'requests_per_second': rate,
+        'latency_ms': latency,
+        'compile_time': compile_time,
+        'skeleton': transform.skeleton is not None,
+        'max_rss_kb': max_rss(),
+    }
+
+
+def scenario_process(queue, *args):
+    try:
+        queue.put((True, run_scenario(*args)))
+    except Exception:
+        queue.put((False, traceback.format_exc()))
+
+
+def run(sizes, rules_names, variant_names, requests, concurrency, options, out=sys.stderr):
+    results = []
+    for size in sizes:
+        for rules, variant in scenarios(rules_names, variant_names):
+            for threads in sorted(set([1, max(concurrency, 1)])):
+                # a process per scenario, so that its peak memory is its own
+                queue = multiprocessing.Queue()
+                process = multiprocessing.Process(target=scenario_process,
+                    args=(queue, size, rules, variant, threads, requests, options))
+                process.start()
+                ok, result = queue.get()
+                process.join()
+                if not ok:
+                    raise RuntimeError("Scenario %s/%s/%d/%d failed:\n%s" % (
+                                       rules, variant, size, threads, result))
+                results.append(result)
+                out.write("%-32s %10.1f req/s  p50 %8.1f ms  p99 %8.1f ms\n" % (
+                          result['name'], result['requests_per_second'],
+                          result['latency_ms']['p50'], result['latency_ms']['p99']))
+    return results
+
+
+def environment():
+    versions = {}
+    for name in ('lxml', 'xdv', 'dv.xdvserver'):
+        try:
+            versions[name] = pkg_resources.get_distribution(name).version
+        except pkg_resources.DistributionNotFound:
+            versions[name] = None
+    versions['libxml2'] = '.'.join(map(str, etree.LIBXML_VERSION))
+    versions['libxslt'] = '.'.join(map(str, etree.LIBXSLT_VERSION))
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'versions': versions,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def compare(previous, results, out=sys.stderr):
+    """Print the change in requests per second from a previous run
+    """
+    before = dict([(result['name'], result) for result in previous['results']])
+    for result in results:
+        old = before.get(result['name'])
+        if old is None:
+            continue
+        change = result['requests_per_second'] / old['requests_per_second'] - 1
+        out.write("%-32s %10.1f -> %10.1f req/s  %+6.1f%%\n" % (result['name'],
+                  old['requests_per_second'], result['requests_per_second'], change * 100))
+
+
+def parse_option(value):
+    name, _, value = value.partition('=')
+    if value.lower() in ('true', 'false'):
+        value = value.lower() == 'true'
+    return name.strip(), value
+
+
+def main():
+    """Called from console script
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option("-s", "--sizes", default=DEFAULT_SIZES,
+                      help="Comma separated page sizes (default: %s)" % DEFAULT_SIZES)
+    parser.add_option("-r", "--rules", action="append", dest="rules", default=[],
+                      help="Rule set to run: %s (default: all)" % ', '.join(sorted(RULES)))
+    parser.add_option("-v", "--variant", action="append", dest="variants", default=[],
+                      help="Compiler variant to run: %s (default: all)" % ', '.join(sorted(VARIANTS)))
+    parser.add_option("-n", "--requests", type="int", default=20,
+                      help="Requests per scenario (default: 20)")
+    parser.add_option("-c", "--concurrency", type="int", default=4,
+                      help="Threads for the concurrent runs (default: 4)")
+    parser.add_option("-O", "--option", action="append", dest="options", default=[],
+                      metavar="NAME=VALUE", help="Filter option, e.g. pool_size=4")
+    parser.add_option("-o", "--output", metavar="results.json",
+                      help="Write the results to this file instead of stdout")
+    parser.add_option("--compare", metavar="previous.json",
+                      help="Report the change from the results of a previous run")
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error("Wrong number of arguments.")
+    for name in options.rules:
+        if name not in RULES:
+            parser.error("Unknown rule set: %s" % name)
+    for name in options.variants:
+        if name not in VARIANTS:
+            parser.error("Unknown variant: %s" % name)
+
+    sizes = [parse_size(size) for size in options.sizes.split(',') if size.strip()]
+    filter_options = dict([parse_option(option) for option in options.options])
+    results = run(sizes, options.rules or sorted(RULES), options.variants or sorted(VARIANTS),
+                  options.requests, options.concurrency, filter_options)
+
+    report = environment()
+    report['options'] = filter_options
+    report['results'] = results
+    data = json.dumps(report, sort_keys=True, indent=2)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+    else:
+        print(data)
+
+    if options.compare:
+        f = open(options.compare)
+        try:
+            previous = json.load(f)
+        finally:
+            f.close()
+        compare(previous, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+import time
+import threading
+
+from dv.xdvserver.stats import Counters
+
+
+class LRUCache(object):
+    """A thread safe mapping that discards the least recently used entries
+    once the total size of its values exceeds ``max_size`` bytes or it holds
+    more than ``max_items`` entries. Entries may also be given a time to live.
+    ``on_evict`` is called with the key and value of each evicted entry.
+    """
+
+    def __init__(self, max_size=None, max_items=None, on_evict=None):
+        self.max_size = max_size
+        self.max_items = max_items
+        self.on_evict = on_evict
+        self.size = 0
+        self.lock = threading.Lock()
+        self.counters = Counters('hits', 'misses', 'stores', 'evictions')
+        # key -> [previous, next, key, value, size, expires]; the root is a
+        # sentinel of a circular doubly linked list, most recent first
+        self.entries = {}
+        self.root = root = []
+        root[:] = [root, root, None, None, 0, None]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def _unlink(self, entry):
+        previous, next = entry[0], entry[1]
+        previous[1] = next
+        next[0] = previous
+
+    def _link_first(self, entry):
+        root = self.root
+        first = root[1]
+        entry[0] = root
+        entry[1] = first
+        first[0] = entry
+        root[1] = entry
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self.entries[entry[2]]
+        self.size -= entry[4]
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None and entry[5] is not None and entry[5] < time.time():
+                self._remove(entry)
+                entry = None
+            if entry is None:
+                self.counters.increment('misses')
+                return default
+            self._unlink(entry)
+            self._link_first(entry)
+            self.counters.increment('hits')
+            return entry[3]
+        finally:
+            self.lock.release()
+
+    def peek(self, key, default=None):
+        """Return the value of ``key`` without counting a hit or a miss or
+        making it the most recently used
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            return entry[3]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, size=None, ttl=None):
+        """Store ``value``. ``size`` defaults to ``len(value)``. Values larger
+        than the whole cache are not stored. Returns whether it was stored.
+        """
+        if size is None:
+            size = len(value)
+        if self.max_size is not None and size > self.max_size:
+            return False
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self._remove(entry)
+            entry = [None, None, key, value, size, expires]
+            self._link_first(entry)
+            self.entries[key] = entry
+            self.size += size
+            self.counters.increment('stores')
+            evicted = self._evict()
+        finally:
+            self.lock.release()
+        if self.on_evict is not None:
+            for entry in evicted:
+                self.on_evict(entry[2], entry[3])
+        return True
+
+    def _evict(self):
+        root = self.root
+        evicted = []
+        while root[0] is not root and (
+                (self.max_size is not None and self.size > self.max_size) or
+                (self.max_items is not None and len(self.entries) > self.max_items)):
+            evicted.append(root[0])
+            self._remove(root[0])
+            self.counters.increment('evictions')
+        return evicted
+
+    def pop(self, key, default=None):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            self._remove(entry)
+            return entry[3]
+        finally:
+            self.lock.release()
+
+    def keys(self):
+        """Return the keys, most recently used first
+        """
+        self.lock.acquire()
+        try:
+            keys = []
+            entry = self.root[1]
+            while entry is not self.root:
+                keys.append(entry[2])
+                entry = entry[1]
+            return keys
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.root[:] = [self.root, self.root, None, None, 0, None]
+            self.size = 0
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        stats = self.counters.snapshot()
+        stats['entries'] = len(self.entries)
+        stats['size'] = self.size
+        return stats
@@ -0,0 +1,85 @@
+import zlib
+
+CODINGS = ('gzip', 'deflate')
+
+# wbits values for zlib: 32 + MAX_WBITS detects a gzip or zlib header,
+# 16 + MAX_WBITS writes a gzip header, MAX_WBITS a zlib one
+WBITS_DETECT = 32 + zlib.MAX_WBITS
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+def decompressing(chunks, coding):
+    """Decode an iterable of ``gzip`` or ``deflate`` encoded chunks
+    """
+    decompressor = None
+    for chunk in chunks:
+        if decompressor is None:
+            decompressor = zlib.decompressobj(WBITS_DETECT)
+            try:
+                data = decompressor.decompress(chunk)
+            except zlib.error:
+                if coding != 'deflate':
+                    raise
+                # some servers send a raw deflate stream without zlib header
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                data = decompressor.decompress(chunk)
+        else:
+            data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if decompressor is not None:
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+def compress(data, coding, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[coding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def compressing(chunks, coding, level):
+    """Encode an iterable of chunks, flushing after each chunk so that none
+    is held back waiting for the next
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[coding])
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def accepted_coding(accept_encoding):
+    """Return the content coding to use given the value of an
+    Accept-Encoding request header: 'gzip', 'deflate' or None for identity
+    """
+    qualities = {}
+    for item in (accept_encoding or '').split(','):
+        parts = item.split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        qualities[coding] = quality
+
+    best = None
+    best_quality = 0.0
+    for coding in CODINGS:
+        quality = qualities.get(coding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best = coding
+            best_quality = quality
+    return best
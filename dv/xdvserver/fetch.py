@@ -0,0 +1,164 @@
+import urllib2
+import urlparse
+import threading
+
+from StringIO import StringIO
+
+from paste.request import construct_url
+from paste.response import header_value
+from paste.wsgilib import intercept_output
+
+# Request headers passed on to subrequests, so that fragments are rendered
+# for the same user and site as the page that includes them
+FORWARDED_KEYS = ('SERVER_NAME', 'SERVER_PORT', 'SERVER_PROTOCOL', 'HTTP_HOST',
+                  'HTTP_COOKIE', 'HTTP_AUTHORIZATION', 'HTTP_ACCEPT_LANGUAGE',
+                  'HTTP_USER_AGENT', 'REMOTE_ADDR', 'REMOTE_USER')
+
+# The forwarded headers that identify the user
+CREDENTIAL_KEYS = ('HTTP_COOKIE', 'HTTP_AUTHORIZATION')
+
+
+def is_same_origin(environ, url):
+    """Return True if ``url`` is served by the same host as the request
+    """
+    scheme, netloc = urlparse.urlparse(url)[:2]
+    origin = urlparse.urlparse(construct_url(environ, with_query_string=False))
+    return (scheme, netloc.lower()) == (origin[0], origin[1].lower())
+
+
+def has_credentials(environ):
+    """Return True if the request carries credentials, which are forwarded
+    to the subrequests made for it
+    """
+    for key in CREDENTIAL_KEYS:
+        if environ.get(key):
+            return True
+    return False
+
+
+def fetch_app(app, environ, url):
+    """Fetch ``url``, a URL of the same host as the request described by
+    ``environ``, from the WSGI application ``app`` without going over the
+    network. Returns ``(status, headers, body)``.
+    """
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    subrequest = {
+        'REQUEST_METHOD': 'GET',
+        'QUERY_STRING': query,
+        'CONTENT_LENGTH': '0',
+        'wsgi.input': StringIO(''),
+        'wsgi.errors': environ.get('wsgi.errors'),
+        'wsgi.version': environ.get('wsgi.version', (1, 0)),
+        'wsgi.url_scheme': environ.get('wsgi.url_scheme', 'http'),
+        'wsgi.multithread': environ.get('wsgi.multithread', True),
+        'wsgi.multiprocess': environ.get('wsgi.multiprocess', False),
+        'wsgi.run_once': False,
+    }
+    for key in FORWARDED_KEYS:
+        if key in environ:
+            subrequest[key] = environ[key]
+
+    script_name = environ.get('SCRIPT_NAME', '')
+    if script_name and path.startswith(script_name + '/'):
+        subrequest['SCRIPT_NAME'] = script_name
+        subrequest['PATH_INFO'] = path[len(script_name):]
+    else:
+        subrequest['SCRIPT_NAME'] = ''
+        subrequest['PATH_INFO'] = path or '/'
+
+    return intercept_output(subrequest, app)
+
+
+def fetch_url(url, timeout=None):
+    """Fetch ``url`` over the network. Returns ``(status, headers, body)``.
+    """
+    try:
+        response = urllib2.urlopen(url, timeout=timeout)
+    except urllib2.HTTPError as e:
+        response = e
+    try:
+        status = '%s %s' % (response.code, getattr(response, 'msg', ''))
+        headers = [tuple(line.split(':', 1)) for line in response.info().headers
+                   if ':' in line]
+        headers = [(name.strip(), value.strip()) for name, value in headers]
+        return status, headers, response.read()
+    finally:
+        response.close()
+
+
+def fetch(app, environ, url, read_network=False, timeout=None):
+    """Fetch ``url`` from ``app`` if it is on the same host as the request,
+    or else over the network if ``read_network`` allows it
+    """
+    if is_same_origin(environ, url):
+        return fetch_app(app, environ, url)
+    if not read_network:
+        return '403 Forbidden', [], ''
+    return fetch_url(url, timeout)
+
+
+def fetch_all(app, environ, urls, read_network=False, timeout=None, max_threads=10):
+    """Fetch ``urls`` in parallel, using up to ``max_threads`` threads.
+    Returns a dict from URL to ``(status, headers, body)``; a URL that could
+    not be fetched at all maps to a ``502 Bad Gateway`` status.
+    """
+    urls = list(urls)
+    results = {}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not urls:
+                    return
+                url = urls.pop()
+            finally:
+                lock.release()
+            try:
+                result = fetch(app, environ, url, read_network, timeout)
+            except Exception as e:
+                result = ('502 Bad Gateway', [], str(e))
+            results[url] = result
+
+    if len(urls) == 1:
+        worker()
+        return results
+    threads = [threading.Thread(target=worker) for i in range(min(max_threads, len(urls)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def max_age(headers, credentials=False):
+    """Return how many seconds a response may be cached for according to its
+    Cache-Control header, or None if it must not be cached. A response to a
+    request with ``credentials`` may have been rendered for the user, and is
+    only cached if it is ``public`` or has an ``s-maxage``.
+    """
+    cache_control = header_value(headers, 'cache-control')
+    if not cache_control:
+        return None
+    ages = {}
+    shared = not credentials
+    for directive in cache_control.lower().split(','):
+        name, _, value = directive.strip().partition('=')
+        if name in ('no-store', 'no-cache', 'private'):
+            return None
+        if name in ('public', 's-maxage'):
+            shared = True
+        if name in ('max-age', 's-maxage'):
+            try:
+                ages[name] = int(value.strip('"'))
+            except ValueError:
+                return None
+    if not shared:
+        return None
+    # we are a shared cache, so s-maxage wins
+    age = ages.get('s-maxage', ages.get('max-age'))
+    if not age or age < 0:
+        return None
+    return age
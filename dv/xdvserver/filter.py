@@ -1,7 +1,21 @@
 import re
+import time
 import urllib2
+import hashlib
+import itertools
+import urlparse
+import threading
 import pkg_resources
 import os.path
+import tempfile
+import multiprocessing
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 from lxml import etree
 from lxml import html
@@ -13,6 +27,16 @@ from paste.deploy.converters import asbool
 
 from xdv.compiler import compile_theme
 
+from dv.xdvserver.cache import LRUCache
+from dv.xdvserver.encoding import accepted_coding, compress, compressing, decompressing
+from dv.xdvserver.includes import IncludeResolver
+from dv.xdvserver.pool import TransformPool, POOL_TIMEOUT
+from dv.xdvserver.profile import TemplateProfile
+from dv.xdvserver.resolver import CachingResolver
+from dv.xdvserver.serialize import serialize_chunks
+from dv.xdvserver.skeleton import split_theme
+from dv.xdvserver.stats import Counters, Histograms
+
 IGNORE_EXTENSIONS = ['js', 'css', 'gif', 'jpg', 'jpeg', 'pdf', 'ps', 'doc',
                      'png', 'ico', 'mov', 'mpg', 'mpeg', 'mp3', 'm4a', 'txt',
                      'rtf', 'swf', 'wav', 'zip', 'wmv', 'ppt', 'gz', 'tgz',
@@ -22,12 +46,362 @@ IGNORE_EXTENSIONS = ['js', 'css', 'gif', 'jpg', 'jpeg', 'pdf', 'ps', 'doc',
 IGNORE_URL_PATTERN = re.compile("^.*\.(%s)$" % '|'.join(IGNORE_EXTENSIONS))
 
 
+def bypass_pattern(ignore_paths=(), ignore_extensions=IGNORE_EXTENSIONS):
+    """Compile the notheme path patterns and the ignored extensions into a
+    single regular expression to match against PATH_INFO. The group that
+    matched, ``notheme`` or ``extension``, tells why the path is not themed.
+    """
+    branches = []
+    if ignore_paths:
+        branches.append("(?P<notheme>%s)" % '|'.join(["(?:%s)" % p for p in ignore_paths]))
+    if ignore_extensions:
+        branches.append("(?P<extension>.*\\.(?:%s)$)" % '|'.join(ignore_extensions))
+    if not branches:
+        return None
+    return re.compile('|'.join(branches))
+
+ETAG_THEME_SEPARATOR = '+xdv.'
+
+
+def request_url(environ):
+    """Return the URL of the request, or None if ``environ`` lacks the keys
+    to build it
+    """
+    try:
+        return construct_url(environ)
+    except KeyError:
+        return None
+
+
+def split_etag(etag):
+    """Split an entity tag into its weakness flag and opaque part
+    """
+    etag = etag.strip()
+    weak = etag.startswith('W/')
+    if weak:
+        etag = etag[2:]
+    if len(etag) >= 2 and etag.startswith('"') and etag.endswith('"'):
+        etag = etag[1:-1]
+    return weak, etag
+
+
+def strong_etag(headers):
+    """Return the ETag of a response if it is a strong one, which changes
+    whenever the body does, or None
+    """
+    etag = header_value(headers, 'etag')
+    if etag and not split_etag(etag)[0]:
+        return etag
+    return None
+
+
+def themed_etag(etag, version):
+    """Return the entity tag of the themed version of an upstream response
+    with the entity tag ``etag``, for the compiled theme ``version``
+    """
+    weak, opaque = split_etag(etag)
+    return '%s"%s%s%s"' % (weak and 'W/' or '', opaque, ETAG_THEME_SEPARATOR, version)
+
+def intercept_chunks(environ, application, conditional, start_response):
+    """Like ``paste.wsgilib.intercept_output``, but rather than joining the
+    body of an intercepted response, return it as an iterator of chunks that
+    reads from the application as it is consumed. Closing the iterator closes
+    the application's response.
+    """
+    captured = []
+    written = []
+    def replacement_start_response(status, headers, exc_info=None):
+        if not conditional(status, headers):
+            captured.append(None)
+            return start_response(status, headers, exc_info)
+        captured[:] = [status, headers]
+        return written.append
+    app_iter = application(environ, replacement_start_response)
+    if captured[0] is None:
+        return (None, None, app_iter)
+    
+    def chunks():
+        try:
+            for chunk in app_iter:
+                while written:
+                    yield written.pop(0)
+                yield chunk
+            while written:
+                yield written.pop(0)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+    return (captured[0], captured[1], chunks())
+
+
+def digesting(chunks, digest):
+    """Pass ``chunks`` through, updating ``digest`` with each
+    """
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+def measuring(chunks, histograms, size_name, stage=None):
+    """Pass ``chunks`` through, and once they have all been read record
+    their total size as ``size_name`` and, if given, the milliseconds spent
+    producing them as ``stage``
+    """
+    size = 0
+    elapsed = 0
+    chunks = iter(chunks)
+    while True:
+        start = time.time()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            break
+        elapsed += time.time() - start
+        size += len(chunk)
+        yield chunk
+    histograms.record(size_name, size)
+    if stage is not None:
+        histograms.record(stage, elapsed * 1000)
+
+
+TIMING_STAGES = ('upstream', 'parse', 'pool', 'transform', 'includes',
+                 'serialize', 'total')
+
+
+def timing_header(timings):
+    """Format the stage timings of a request, in seconds, as the value of
+    a Server-Timing header
+    """
+    return ', '.join(['%s;dur=%.1f' % (stage, timings[stage] * 1000)
+                      for stage in TIMING_STAGES if stage in timings])
+
+
+def storing(chunks, cache, key):
+    """Pass ``chunks`` through, and store them joined in ``cache`` once
+    they have all been read
+    """
+    buffer = []
+    for chunk in chunks:
+        buffer.append(chunk)
+        yield chunk
+    cache.set(key, ''.join(buffer))
+
+
+class Releasing(object):
+    """Pass ``chunks`` through, and release ``semaphore`` once they have all
+    been read, or when closed or dropped before that
+    """
+    
+    def __init__(self, chunks, semaphore):
+        self.chunks = iter(chunks)
+        self.semaphore = semaphore
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        try:
+            return next(self.chunks)
+        except Exception:
+            self.close()
+            raise
+    
+    def close(self):
+        semaphore, self.semaphore = self.semaphore, None
+        if semaphore is None:
+            return
+        try:
+            if hasattr(self.chunks, 'close'):
+                self.chunks.close()
+        finally:
+            semaphore.release()
+    
+    def __del__(self):
+        self.close()
+
+XINCLUDE_INCLUDE = '{http://www.w3.org/2001/XInclude}include'
+
+
+def is_url(location):
+    """Return True if ``location`` looks like a URL rather than a file path
+    """
+    return urlparse.urlparse(location)[0] in ('http', 'https', 'ftp', 'file')
+
+
+def read_resource(location):
+    """Return the content of the file or URL at ``location``
+    """
+    if is_url(location):
+        f = urllib2.urlopen(location)
+    else:
+        f = open(location, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def resource_signature(location):
+    """Return a token that changes whenever the resource at ``location``
+    changes: the mtime and size for a local file, or a digest of the content
+    for a URL. Missing resources give None.
+    """
+    if not location:
+        return None
+    if is_url(location):
+        try:
+            return hashlib.md5(read_resource(location)).hexdigest()
+        except (IOError, ValueError):
+            return None
+    try:
+        stat = os.stat(location)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+def xinclude_locations(location, parser=None, _seen=None):
+    """Return the locations of all documents pulled into ``location``
+    (recursively) through XInclude
+    """
+    if _seen is None:
+        _seen = set()
+    found = []
+    try:
+        tree = etree.parse(location, parser=parser)
+    except (IOError, etree.XMLSyntaxError):
+        return found
+    for include in tree.getroot().iter(XINCLUDE_INCLUDE):
+        href = include.get('href')
+        if not href:
+            continue
+        if is_url(location) or is_url(href):
+            href = urlparse.urljoin(location, href)
+        else:
+            href = os.path.join(os.path.dirname(location), href)
+        if href in _seen:
+            continue
+        _seen.add(href)
+        found.append(href)
+        if include.get('parse', 'xml') == 'xml':
+            found.extend(xinclude_locations(href, parser, _seen))
+    return found
+
+
+class Degraded(Exception):
+    """Theming a page would exceed one of the limits of the middleware. The
+    argument is the name of the limit.
+    """
+
+
+class ThreadTransform(object):
+    """Holds the ``etree.XSLT`` of one thread, and keeps count of how many
+    are alive: the holder goes away with its thread or with the middleware
+    that created it when the theme is recompiled.
+    """
+    
+    def __init__(self, transform, counters, build_time):
+        self.transform = transform
+        self.counters = counters
+        self.profile_totals = {}
+        counters.increment('instances')
+        counters.increment('built')
+        counters.increment('build_time', build_time)
+    
+    def __del__(self):
+        self.counters.increment('instances', -1)
+
+
 class XSLTMiddleware(object):
     """Apply XSLT in middleware
     """
     
-    def __init__(self, app, global_conf, ignore_paths=None, xslt_file=None, xslt_source="", xslt_tree=None, read_network=False):
+    def __init__(self, app, global_conf, ignore_paths=None, xslt_file=None, xslt_source="", xslt_tree=None, read_network=False,
+                 counters=None, response_cache_size=0, response_cache=None,
+                 etags=True, feed_parser=False, stream_output=False,
+                 compress_level=0, compress_min_size=1024,
+                 pool_size=0, pool_timeout=POOL_TIMEOUT, thread_transforms=True,
+                 transform_counters=None, include_resolver=None, resolver=None,
+                 timings=None, timing_header=None, stats_path=None,
+                 profile_every=0, rules=None, max_body_size=0,
+                 max_transform_time=None, max_concurrent=0, skeleton=False):
         """Initialise, giving a filename or file pointer for an XSLT file.
+        
+        ``counters`` may be passed in to keep the request counters of a
+        previous instance, e.g. when the theme is recompiled.
+        
+        ``response_cache_size`` enables an in-process cache of themed
+        responses holding up to that many bytes. A shared ``LRUCache`` can be
+        passed as ``response_cache`` instead.
+        
+        ``etags`` can be set to False to pass the upstream ETag through as is
+        rather than deriving a themed ETag from it and the theme version.
+        
+        ``feed_parser`` can be set to True to parse the upstream body chunk by
+        chunk as the application produces it, rather than after joining it
+        into one string.
+        
+        ``stream_output`` can be set to True to send the themed page as it is
+        serialized, in chunks and without a Content-Length, rather than
+        serializing it to one string first.
+        
+        ``compress_level`` can be set to a zlib compression level from 1 to 9
+        to gzip or deflate the themed page when the client accepts it. Pages
+        shorter than ``compress_min_size`` bytes are sent uncompressed.
+        Compressed upstream bodies are decompressed before theming either way.
+        
+        ``pool_size`` can be set to a number of worker processes that parse,
+        transform and serialize pages, each with its own copy of the compiled
+        stylesheet. If the pool fails or takes longer than ``pool_timeout``
+        seconds (30 by default), the page is themed in the request thread
+        instead.
+        
+        With ``thread_transforms`` (the default), each thread builds its own
+        ``etree.XSLT`` from the compiled stylesheet the first time it themes
+        a page, rather than all threads sharing one. ``transform_counters``
+        may be passed in to keep accounting for these across instances.
+        
+        ``include_resolver`` can be set to an ``IncludeResolver`` to replace
+        ESI and SSI includes in themed pages with the fragments they refer to.
+        The response cache then keeps pages before their includes are
+        resolved, which happens on every request, and themed pages get no
+        ETag or Last-Modified, as the fragments may change on their own.
+        
+        ``resolver`` can be set to a ``CachingResolver`` to cache the targets
+        of ``document()`` calls in the stylesheet. Worker processes of the
+        transform pool do without it.
+        
+        ``timings`` can be set to a ``Histograms`` to collect the time spent
+        in each stage of theming a page (in milliseconds) and the size of
+        pages before and after theming. ``timing_header`` can be set to the
+        name of a response header, such as ``Server-Timing``, in which to
+        report the stage timings of each themed page; it implies collecting
+        timings. ``stats_path`` can be set to a path at which the middleware
+        answers with its statistics as JSON.
+        
+        ``profile_every`` can be set to N to profile every Nth transform run
+        in the request thread, and keep the time spent in and the number of
+        calls to each template of the stylesheet. ``rules`` is the xdv rules
+        file the stylesheet was compiled from, to find the rule each
+        template comes from.
+        
+        Pages are sent unthemed, with an ``X-XDV-Degraded`` header naming the
+        limit, rather than themed when that would exceed a limit: bodies
+        larger than ``max_body_size`` bytes, pages taking longer than
+        ``max_transform_time`` seconds to theme, or more than
+        ``max_concurrent`` pages being themed at once. A themed copy in the
+        response cache is still used. With ``max_transform_time``, pages are
+        themed in a pool of threads (``max_concurrent`` of them, or two per
+        CPU) so that the request can give up waiting; they are serialized
+        there too, so with ``stream_output`` the page is only sent once it
+        has been serialized whole. Otherwise a streamed page keeps its place
+        among the ``max_concurrent`` until it has been sent.
+        
+        ``skeleton`` can be set to True to serialize the parts of the theme
+        that are the same on every page once, and only evaluate the
+        instructions that put content into the theme for each page. Worker
+        processes of the transform pool run the whole stylesheet, as do
+        stylesheets that choose between themes or compute anything else.
         """
         
         self.app = app
@@ -38,18 +412,99 @@ class XSLTMiddleware(object):
             xslt_source = xslt_file.read()
             xslt_file.close()
         
+        self.resolver = resolver
+        
         if xslt_source:
-            xslt_tree = etree.fromstring(xslt_source)
+            xslt_tree = etree.fromstring(xslt_source, parser=self.xml_parser())
         
         self.read_network = read_network
         self.access_control = etree.XSLTAccessControl(read_file=True, write_file=False, create_dir=False, read_network=read_network, write_network=False)
+        self.stylesheet = etree.tostring(xslt_tree)
+        if isinstance(xslt_tree, etree._Element):
+            self.stylesheet_url = xslt_tree.getroottree().docinfo.URL
+        else: # the compiler returns an element tree
+            self.stylesheet_url = xslt_tree.docinfo.URL
+        if resolver is not None and not xslt_source:
+            # document() uses the resolvers of the stylesheet's parser
+            xslt_tree = etree.fromstring(self.stylesheet, parser=self.xml_parser(),
+                                         base_url=self.stylesheet_url)
+        self.transform_stylesheet = self.stylesheet
+        self.skeleton = None
+        if asbool(skeleton):
+            self.skeleton = split_theme(self.stylesheet)
+        if self.skeleton is not None:
+            # the stylesheet of the regions replaces the whole theme
+            self.transform_stylesheet = self.skeleton.stylesheet
+            xslt_tree = etree.fromstring(self.transform_stylesheet, parser=self.xml_parser(),
+                                         base_url=self.stylesheet_url)
         self.transform = etree.XSLT(xslt_tree, access_control=self.access_control)
+        self.version = hashlib.sha1(self.stylesheet).hexdigest()[:12]
+        
+        self.thread_transforms = asbool(thread_transforms)
+        self.local = threading.local()
+        if transform_counters is None:
+            transform_counters = Counters('instances', 'built', 'build_time')
+        self.transform_counters = transform_counters
         
         self.ignore_paths = []
         if ignore_paths:
             ignore_paths = [s.strip() for s in ignore_paths if s.strip()]
             for p in ignore_paths:
                 self.ignore_paths.append(re.compile(p))
+        self.bypass_pattern = bypass_pattern(ignore_paths)
+        
+        if counters is None:
+            counters = Counters('notheme', 'extension')
+        self.counters = counters
+        
+        response_cache_size = int(response_cache_size or 0)
+        if response_cache is None and response_cache_size > 0:
+            response_cache = LRUCache(max_size=response_cache_size)
+        self.response_cache = response_cache
+        # the upstream validators do not cover included fragments
+        self.etags = asbool(etags) and include_resolver is None
+        self.feed_parser = asbool(feed_parser)
+        self.stream_output = asbool(stream_output)
+        self.compress_level = int(compress_level or 0)
+        self.compress_min_size = int(compress_min_size or 0)
+        
+        self.include_resolver = include_resolver
+        
+        self.timing_header = timing_header or None
+        if timings is None and self.timing_header:
+            timings = Histograms()
+        self.timings = timings
+        self.stats_path = stats_path or None
+        
+        self.max_body_size = int(max_body_size or 0)
+        self.max_transform_time = None
+        if max_transform_time:
+            self.max_transform_time = float(max_transform_time)
+        # the body is kept whole so that it can be sent unthemed
+        self.buffer_body = bool(self.max_body_size or self.max_transform_time)
+        self.admission = None
+        if int(max_concurrent or 0) > 0:
+            self.admission = threading.Semaphore(int(max_concurrent))
+        self.transform_threads = None
+        if self.max_transform_time:
+            self.transform_threads = ThreadPool(int(max_concurrent or 0) or
+                                                2 * multiprocessing.cpu_count())
+        
+        self.profile_every = int(profile_every or 0)
+        self.profile = None
+        if self.profile_every > 0:
+            self.profile = TemplateProfile(self.stylesheet, rules)
+            self.profile_counter = itertools.count(1)
+            self.profile_totals = {}
+        
+        self.transform_pool = None
+        if int(pool_size or 0) > 0:
+            self.transform_pool = TransformPool(self.stylesheet,
+                    read_network=asbool(read_network),
+                    processes=int(pool_size),
+                    timeout=float(pool_timeout),
+                )
+        self.closed = False
         
     def should_intercept(self, status, headers):
         """Callback to determine if the content should be intercepted
@@ -65,11 +520,146 @@ class XSLTMiddleware(object):
         return (content_type.startswith('text/html') or
                 content_type.startswith('application/xhtml+xml'))
     
-    def apply_transform(self, environ, body):
+    def xml_parser(self):
+        """Return a parser for the stylesheet, using the resolver if any
+        """
+        parser = etree.XMLParser()
+        if self.resolver is not None:
+            parser.resolvers.add(self.resolver)
+        return parser
+    
+    def parse(self, body, base_url=None):
+        """Parse the upstream body, given as a string or an iterable of
+        chunks which are fed to the parser as they are read. Relative URLs
+        in ``document()`` calls are resolved against ``base_url``.
+        """
+        if isinstance(body, etree._Element):
+            return body
+        parser = etree.HTMLParser()
+        if isinstance(body, basestring):
+            return etree.fromstring(body, parser=parser, base_url=base_url)
+        for chunk in body:
+            parser.feed(chunk)
+        content = parser.close()
+        if base_url is not None:
+            content.getroottree().docinfo.URL = base_url
+        return content
+    
+    def apply_transform(self, environ, body, includes=True):
+        """Theme and serialize the page, and resolve its includes unless
+        ``includes`` is False
+        """
+        if includes and self.include_resolver is None:
+            includes = False
         
-        content = etree.fromstring(body, parser=etree.HTMLParser())
-        transformed = self.transform(content)
-        return html.tostring(transformed)
+        if self.transform_pool is not None and not isinstance(body, etree._Element):
+            if not isinstance(body, basestring):
+                body = ''.join(body)
+            try:
+                themed = self.timed(environ, 'pool', self.transform_pool, body)
+            except Exception:
+                pass # theme it here instead
+            else:
+                if includes:
+                    themed = self.timed(environ, 'includes',
+                                        self.include_resolver.resolve_string,
+                                        environ, themed)
+                return themed
+        
+        content = self.timed(environ, 'parse', self.parse, body, request_url(environ))
+        transformed = self.timed(environ, 'transform', self.run_transform, environ, content)
+        if self.skeleton is not None:
+            themed = self.timed(environ, 'serialize', self.skeleton.serialize, transformed)
+            if includes:
+                themed = self.timed(environ, 'includes',
+                                    self.include_resolver.resolve_string,
+                                    environ, themed)
+            return themed
+        if includes:
+            self.timed(environ, 'includes', self.include_resolver.resolve_tree,
+                       environ, transformed)
+        return self.timed(environ, 'serialize', html.tostring, transformed)
+    
+    def apply_transform_chunks(self, environ, body):
+        """Like ``apply_transform``, but return the serialized result as an
+        iterator of chunks
+        """
+        if self.transform_pool is not None or (self.skeleton is not None and
+                                               self.include_resolver is not None):
+            return [self.apply_transform(environ, body)]
+        content = self.timed(environ, 'parse', self.parse, body, request_url(environ))
+        transformed = self.timed(environ, 'transform', self.run_transform, environ, content)
+        if self.include_resolver is not None:
+            self.timed(environ, 'includes', self.include_resolver.resolve_tree,
+                       environ, transformed)
+        if self.skeleton is not None:
+            # the static parts go out between the regions as they are
+            # serialized
+            chunks = self.skeleton.chunks(transformed)
+        else:
+            chunks = serialize_chunks(transformed)
+        if self.timings is not None:
+            # serialized after the headers are sent, so only aggregated
+            chunks = measuring(chunks, self.timings, 'bytes_out', 'serialize')
+        return chunks
+    
+    def timed(self, environ, stage, func, *args):
+        """Call ``func``, adding the time it took to the ``stage`` timing of
+        the request if timings are collected
+        """
+        timings = environ.get('xdv.timings')
+        if timings is None:
+            return func(*args)
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            timings[stage] = timings.get(stage, 0) + time.time() - start
+    
+    def run_transform(self, environ, content):
+        """Transform the parsed ``content``, letting the resolver request
+        resources on the same host from the application on behalf of this
+        request
+        """
+        if self.resolver is None:
+            return self.call_transform(content)
+        # xdv's document() calls are relative to content that has been through
+        # a result tree fragment, which has lost the base URL it was parsed with
+        previous = self.resolver.bind(environ, request_url(environ))
+        try:
+            return self.call_transform(content)
+        finally:
+            self.resolver.bind(*previous)
+    
+    def call_transform(self, content):
+        """Apply the transform of this thread, profiling it if it is this
+        transform's turn
+        """
+        transform = self.get_transform()
+        if self.profile is None or next(self.profile_counter) % self.profile_every:
+            return transform(content)
+        result = transform(content, profile_run=True)
+        totals = self.profile_totals
+        if self.thread_transforms:
+            totals = self.local.holder.profile_totals
+        self.profile.add(result.xslt_profile, totals)
+        return result
+    
+    def get_transform(self):
+        """Return the ``etree.XSLT`` to use in this thread, building it the
+        first time the thread asks for it
+        """
+        if not self.thread_transforms:
+            return self.transform
+        holder = getattr(self.local, 'holder', None)
+        if holder is None:
+            start = time.time()
+            stylesheet = etree.fromstring(self.transform_stylesheet, parser=self.xml_parser(),
+                                          base_url=self.stylesheet_url)
+            transform = etree.XSLT(stylesheet, access_control=self.access_control)
+            holder = self.local.holder = ThreadTransform(transform,
+                    self.transform_counters, time.time() - start)
+        return holder.transform
     
     def __call__(self, environ, start_response):
         
@@ -78,43 +668,392 @@ class XSLTMiddleware(object):
         if not path:
             path = environ['PATH_INFO'] = '/'
         
-        status, headers, body = intercept_output(environ, self.app,
-                                                 self.should_intercept,
-                                                 start_response)
+        if self.stats_path is not None and path == self.stats_path:
+            return self.stats_app(environ, start_response)
+        
+        # don't style if the url should not be styled or is not likely to be
+        # HTML; let the response stream through without buffering it
+        reason = self.bypass_reason(environ)
+        if reason is not None:
+            self.counters.increment(reason)
+            return self.app(environ, start_response)
+        
+        timings = None
+        if self.timings is not None:
+            timings = environ['xdv.timings'] = {}
+            start = time.time()
+        
+        validated = []
+        if self.etags:
+            validated = self.rewrite_if_none_match(environ)
+        
+        if self.feed_parser:
+            status, headers, body = intercept_chunks(environ, self.app,
+                                                     self.should_intercept,
+                                                     start_response)
+        else:
+            status, headers, body = intercept_output(environ, self.app,
+                                                     self.should_intercept,
+                                                     start_response)
+        if timings is not None:
+            # with feed_parser, reading the body is part of parsing it
+            timings['upstream'] = time.time() - start
+            environ['xdv.timings'] = timings # in case upstream themes too
                                                  
         # self.should_intercept returned nada
         if status is None:
+            self.counters.increment('not_html')
             return body
         
-        # don't style if the url should not be styled
-        for pattern in self.ignore_paths:
-            if pattern.match(path):
-                start_response(status, headers)
-                return [body]
-        
-        # short circuit from theming if this is not likely to be HTML
-        content_url = construct_url(environ)
-        if self.should_ignore_url(content_url):
-            start_response(status, headers)
-            return [body]
+        etag = header_value(headers, 'etag')
+        if self.etags and etag:
+            # the upstream validated the themed copy the client holds
+            if status.startswith('304') and split_etag(etag)[1] in validated:
+                replace_header(headers, 'etag', themed_etag(etag, self.version))
             
+            # the upstream ignored the condition, but we can tell that the
+            # client has this page themed with the current theme already
+            elif (status.startswith('200') and split_etag(etag)[1] in validated and
+                    environ.get('REQUEST_METHOD', 'GET') in ('GET', 'HEAD')):
+                headers = [(name, value) for name, value in headers
+                           if name.lower() not in ('content-length', 'content-type')]
+                replace_header(headers, 'etag', themed_etag(etag, self.version))
+                if hasattr(body, 'close'):
+                    body.close()
+                self.counters.increment('not_modified')
+                start_response('304 Not Modified', headers)
+                return []
+        
+        if isinstance(body, basestring):
+            body = [body]
+        
         # short circuit if we have a 3xx, 204 or 401 error code
         status_code = status.split()[0]
         if status_code.startswith('3') or status_code == '204' or status_code == '401':
+            self.counters.increment('passed')
             start_response(status, headers)
-            return [body]
+            return body
+        
+        # decode compressed bodies, and leave alone those we can't decode
+        coding = (header_value(headers, 'content-encoding') or 'identity').strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        if coding in ('gzip', 'deflate'):
+            body = decompressing(body, coding)
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != 'content-encoding']
+        elif coding != 'identity':
+            self.counters.increment('passed')
+            start_response(status, headers)
+            return body
+        
+        if timings is not None:
+            body = measuring(body, self.timings, 'bytes_in')
+        if self.buffer_body:
+            body = [''.join(body)]
         
-        # all good - apply the transform
-        body = self.apply_transform(environ, body)
+        # all good - apply the transform, unless this very response has been
+        # themed before
+        key = themed = None
+        if self.response_cache is not None:
+            digest = None
+            if not strong_etag(headers):
+                # the key needs a digest of the body: take it while parsing
+                digest = hashlib.sha1()
+                if self.transform_pool is None and not self.buffer_body:
+                    body = self.timed(environ, 'parse', self.parse, digesting(body, digest),
+                                      request_url(environ))
+                else:
+                    body = ''.join(digesting(body, digest))
+            key = self.response_cache_key(environ, status, headers, digest)
+            if key is not None:
+                themed = self.response_cache.get(key)
+        # fragments are not cached with the page, as they may change
+        # while it does not
+        includes = key is not None and self.include_resolver is not None
+        if themed is None:
+            try:
+                themed = self.guarded_transform(environ, body, not includes)
+            except Degraded as e:
+                return self.degrade(start_response, status, headers, body, e.args[0])
+            if key is not None:
+                if self.stream_output and not includes:
+                    themed = storing(themed, self.response_cache, key)
+                else:
+                    self.response_cache.set(key, themed)
+        if includes:
+            themed = self.timed(environ, 'includes', self.include_resolver.resolve_string,
+                                environ, themed)
+        self.counters.increment('themed')
         
-        replace_header(headers, 'content-length', str(len(body)))
+        if isinstance(themed, basestring):
+            body = [themed]
+            replace_header(headers, 'content-length', str(len(themed)))
+        else:
+            # the length is not known until the last chunk is serialized
+            body = themed
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != 'content-length']
         replace_header(headers, 'content-type', 'text/html; charset=utf-8')
+        if self.etags and etag:
+            replace_header(headers, 'etag', themed_etag(etag, self.version))
+        if self.include_resolver is not None:
+            headers = [(name, value) for name, value in headers
+                       if name.lower() not in ('etag', 'last-modified')]
+        if self.compress_level:
+            headers, body = self.encode_output(environ, headers, body)
+        
+        if timings is not None:
+            timings['total'] = time.time() - start
+            for stage, elapsed in timings.items():
+                self.timings.record(stage, elapsed * 1000)
+            if isinstance(themed, basestring):
+                self.timings.record('bytes_out', len(themed))
+            if self.timing_header:
+                headers.append((self.timing_header, timing_header(timings)))
         
         start_response(status, headers)
+        return body
+    
+    def stats(self):
+        """Return the statistics of the middleware, its caches and pool
+        """
+        stats = {
+            'version': self.version,
+            'skeleton': self.skeleton is not None,
+            'requests': self.counters.snapshot(),
+            'transforms': self.transform_counters.snapshot(),
+        }
+        if self.timings is not None:
+            stats['timings'] = self.timings.snapshot()
+        if self.response_cache is not None:
+            stats['response_cache'] = self.response_cache.stats()
+        if self.transform_pool is not None:
+            stats['pool'] = self.transform_pool.stats()
+        if self.include_resolver is not None:
+            stats['includes'] = self.include_resolver.stats()
+        if self.resolver is not None:
+            stats['resources'] = self.resolver.stats()
+        if self.profile is not None:
+            stats['profile'] = self.profile.report()
+        return stats
+    
+    def stats_app(self, environ, start_response):
+        """Answer with the statistics as JSON
+        """
+        body = json.dumps(self.stats(), sort_keys=True, indent=2)
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body))),
+                                  ('Cache-Control', 'no-cache')])
         return [body]
+    
+    def guarded_transform(self, environ, body, includes=True):
+        """Theme the page within the limits of the middleware. Raises
+        ``Degraded`` if a limit would be exceeded. Without ``includes``, the
+        page is returned whole with its includes left to resolve.
+        """
+        if not includes:
+            apply = lambda environ, body: self.apply_transform(environ, body, False)
+        elif self.stream_output:
+            apply = self.apply_transform_chunks
+        else:
+            apply = self.apply_transform
+        
+        if self.max_body_size:
+            if isinstance(body, basestring):
+                size = len(body)
+            else:
+                size = sum([len(chunk) for chunk in body])
+            if size > self.max_body_size:
+                raise Degraded('body-size')
+        
+        admission = self.admission
+        if admission is not None and not admission.acquire(False):
+            raise Degraded('concurrency')
+        
+        def theme_here():
+            held = admission
+            try:
+                themed = apply(environ, body)
+                if admission is not None and self.stream_output:
+                    # serialized as it is sent: keep the place until then
+                    themed, held = Releasing(themed, admission), None
+                return themed
+            finally:
+                if held is not None:
+                    held.release()
+        
+        # Requests that got this middleware before the theme was recompiled
+        # or dropped may still be running after it was closed
+        if self.transform_threads is None or self.closed:
+            return theme_here()
+        
+        abandoned = threading.Event()
+        def theme():
+            # a page given up on keeps its place until it is done with
+            try:
+                if not abandoned.is_set():
+                    themed = apply(environ, body)
+                    if self.stream_output:
+                        # serialize within the time limit
+                        themed = list(themed)
+                    return themed
+            finally:
+                if admission is not None:
+                    admission.release()
+        try:
+            result = self.transform_threads.apply_async(theme)
+        except (AssertionError, ValueError):
+            return theme_here() # closed just now
+        try:
+            return result.get(self.max_transform_time)
+        except multiprocessing.TimeoutError:
+            abandoned.set()
+            raise Degraded('transform-time')
+    
+    def degrade(self, start_response, status, headers, body, reason):
+        """Send the page unthemed, as theming it would exceed the limit
+        named by ``reason``
+        """
+        self.counters.increment('degraded_' + reason.replace('-', '_'))
+        if isinstance(body, etree._Element):
+            # parsed already to look it up in the response cache
+            body = [html.tostring(body.getroottree())]
+        headers = [(name, value) for name, value in headers
+                   if name.lower() != 'content-length']
+        if isinstance(body, list):
+            headers.append(('Content-Length', str(sum([len(chunk) for chunk in body]))))
+        # not to be kept in place of the themed page by downstream caches
+        replace_header(headers, 'cache-control', 'no-store')
+        headers.append(('X-XDV-Degraded', reason))
+        start_response(status, headers)
+        return body
+    
+    def close(self):
+        """Release the transform pool, once it has finished its pages.
+        Requests still using the middleware theme in their own thread.
+        """
+        self.closed = True
+        if self.transform_pool is not None:
+            self.transform_pool.close()
+        if self.transform_threads is not None:
+            self.transform_threads.close()
+    
+    def encode_output(self, environ, headers, body):
+        """Compress the themed body with the best coding the client accepts
+        """
+        vary = header_value(headers, 'vary')
+        if not vary:
+            headers.append(('Vary', 'Accept-Encoding'))
+        elif 'accept-encoding' not in vary.lower():
+            replace_header(headers, 'vary', vary + ', Accept-Encoding')
+        
+        coding = accepted_coding(environ.get('HTTP_ACCEPT_ENCODING'))
+        if coding is None:
+            return headers, body
+        
+        if isinstance(body, list):
+            body = ''.join(body)
+            if len(body) < self.compress_min_size:
+                return headers, [body]
+            body = [compress(body, coding, self.compress_level)]
+            replace_header(headers, 'content-length', str(len(body[0])))
+        else:
+            body = compressing(body, coding, self.compress_level)
+        replace_header(headers, 'content-encoding', coding)
+        
+        # the compressed bytes differ, so the entity tag can only be weak
+        etag = header_value(headers, 'etag')
+        if etag and not etag.startswith('W/'):
+            replace_header(headers, 'etag', 'W/' + etag)
+        return headers, body
 
+    def rewrite_if_none_match(self, environ):
+        """Translate the themed entity tags in the If-None-Match request
+        header back into the upstream ones, so that the application can
+        validate them. Tags from an older version of the theme are dropped,
+        as the client's copy is stale whatever the application says.
+        
+        Returns the opaque parts of the upstream tags the client holds a
+        themed copy of.
+        """
+        value = environ.get('HTTP_IF_NONE_MATCH')
+        if not value:
+            return []
+        
+        validated = []
+        forward = []
+        for etag in value.split(','):
+            etag = etag.strip()
+            weak, opaque = split_etag(etag)
+            if ETAG_THEME_SEPARATOR not in opaque:
+                forward.append(etag)
+                continue
+            opaque, version = opaque.rsplit(ETAG_THEME_SEPARATOR, 1)
+            if version == self.version:
+                validated.append(opaque)
+                forward.append('%s"%s"' % (weak and 'W/' or '', opaque))
+        
+        if forward:
+            environ['HTTP_IF_NONE_MATCH'] = ', '.join(forward)
+        else:
+            del environ['HTTP_IF_NONE_MATCH']
+        return validated
+    
+    def response_cache_key(self, environ, status, headers, digest):
+        """Return the key under which the themed version of this response
+        can be cached, or None if it must not be cached.
+        
+        The key is made of the method, the URL, the values of the request
+        headers the response varies on, the upstream strong ETag (or a digest
+        of the body when there is none) and the version of the compiled
+        theme. Weak ETags and Last-Modified dates do not identify a body, so
+        when the response has no strong ETag, ``digest`` must be a hashlib
+        object fed with the body.
+        
+        Responses to requests with credentials are not cached: the upstream
+        may render them for the user, and does not have to say so.
+        """
+        method = environ.get('REQUEST_METHOD', 'GET')
+        if method != 'GET' or not status.startswith('200'):
+            return None
+        if environ.get('HTTP_AUTHORIZATION') or environ.get('HTTP_COOKIE'):
+            return None
+        if header_value(headers, 'set-cookie'):
+            return None
+        
+        cache_control = (header_value(headers, 'cache-control') or '').lower()
+        for directive in ('no-store', 'no-cache', 'private'):
+            if directive in cache_control:
+                return None
+        
+        key = [method, construct_url(environ), self.version]
+        vary = header_value(headers, 'vary')
+        if vary:
+            for name in vary.split(','):
+                name = name.strip()
+                if name == '*':
+                    return None
+                key.append(environ.get('HTTP_' + name.upper().replace('-', '_')))
+        
+        key.append(strong_etag(headers) or digest.hexdigest())
+        return tuple(key)
+    
     def should_ignore_url(self, url): 
         return IGNORE_URL_PATTERN.search(url) is not None
+    
+    def bypass_reason(self, environ):
+        """Return why the request should not be themed ('notheme' or
+        'extension'), or None if it should be.
+        """
+        if self.bypass_pattern is None:
+            return None
+        match = self.bypass_pattern.match(environ['PATH_INFO'])
+        if match is None:
+            return None
+        if self.ignore_paths and match.group('notheme') is not None:
+            return 'notheme'
+        return 'extension'
 
 
 class XDVMiddleware(object):
@@ -124,6 +1063,16 @@ class XDVMiddleware(object):
     def __init__(self, app, global_conf, live=False, rules=None, theme=None, extra=None,
                  css=True, xinclude=True, absolute_prefix=None, update=False,
                  includemode='document', notheme=None, read_network=False,
+                 live_interval=0, eager=False, cache_dir=None,
+                 response_cache_size=0, etags=True, feed_parser=False,
+                 stream_output=False, compress_level=0, compress_min_size=1024,
+                 pool_size=0, pool_timeout=POOL_TIMEOUT, thread_transforms=True,
+                 resolve_includes=False, include_cache_size=0,
+                 include_timeout=None, include_threads=10,
+                 resource_cache_size=0, resource_ttl=300, resources_from_app=False,
+                 timing_header=None, stats_path=None, collect_timings=False,
+                 profile_every=0, max_body_size=0, max_transform_time=None,
+                 max_concurrent=0, skeleton=False,
                  # BBB parameters
                  theme_uri=None, extraurl=None):
         """Create the middleware. The parameters are:
@@ -148,7 +1097,93 @@ class XDVMiddleware(object):
           the old Deliverance 0.2 namespace (for a moderate speed gain)
         * ``includemode`` can be set to 'document', 'esi' or 'ssi' to change
           the way in which includes are processed
-        * ``live``, set to True to recompile the theme on each request
+        * ``resolve_includes``, set to True to have the middleware replace the
+          includes of the 'esi' and 'ssi' include modes itself. The fragments
+          of a page are fetched in parallel, from the wrapped application for
+          URLs on the same host and over the network (if ``read_network`` is
+          set) for others.
+        * ``include_cache_size``, the number of bytes of fragments to keep for
+          as long as their Cache-Control header allows
+        * ``include_timeout``, the timeout in seconds for fetching a fragment
+          over the network
+        * ``include_threads``, the maximum number of fragments of a page to
+          fetch at the same time
+        * ``resource_cache_size``, the number of bytes of resources fetched
+          over HTTP to keep: the theme, rules and extra file when compiling,
+          and the targets of ``document()`` calls (as used by the 'document'
+          include mode) when theming. Resources are kept for as long as their
+          Cache-Control header allows, or ``resource_ttl`` seconds if they
+          have none.
+        * ``resource_ttl``, see above. Defaults to 300 seconds.
+        * ``resources_from_app``, set to True to request the resources on the
+          same host as the current request from the wrapped application
+          rather than over the network. ``read_network`` must still be set
+          for ``document()`` to be allowed to load URLs.
+        * ``collect_timings``, set to True to keep histograms of the time
+          spent getting the page from upstream, parsing, transforming and
+          serializing it and compiling the theme, and of the size of pages
+        * ``timing_header``, the name of a response header, such as
+          ``Server-Timing``, in which to report the time spent in each stage
+          of theming the page. Implies ``collect_timings``.
+        * ``stats_path``, a path (e.g. ``/_xdv/stats``) at which the filter
+          answers with its counters, timings and cache statistics as JSON.
+          Protect it as you would any other internal page.
+        * ``profile_every``, set to N to profile every Nth transform and
+          report the time spent in each template of the compiled theme, and
+          the rule it comes from where that can be told, under ``profile`` in
+          the statistics. Profiling slows the sampled transforms down.
+        * ``max_body_size``, the size in bytes above which pages are sent
+          unthemed
+        * ``max_transform_time``, the number of seconds after which a request
+          stops waiting for its page to be themed and sends it unthemed
+        * ``max_concurrent``, the number of pages that may be themed at once;
+          further pages are sent unthemed until one is done. Pages sent
+          unthemed because of one of these limits get an ``X-XDV-Degraded``
+          header naming it, and are counted in the statistics.
+        * ``skeleton``, set to True to serialize the static parts of the
+          theme once and, for each page, only evaluate the rules that put
+          content into it and splice their results in. Themes using
+          conditions or several themes fall back to the whole stylesheet.
+        * ``live``, set to True to watch the rules, theme, extra file and any
+          XIncluded files, and recompile the theme when one of them changes
+        * ``live_interval``, the minimum number of seconds between two checks
+          for changes in live mode. Remote resources are downloaded for each
+          check, so set this when the theme or rules are given as URLs.
+        * ``eager``, set to True to compile the theme when the filter is
+          created rather than on the first request, so that a process whose
+          theme does not compile fails before it takes any traffic.
+        * ``cache_dir``, a directory in which compiled themes are stored,
+          keyed by a digest of the theme inputs and compiler options, so that
+          other processes using the same theme can load it instead of
+          compiling it again
+        * ``response_cache_size``, the number of bytes of themed responses to
+          keep in memory, so that an unchanged upstream response is not
+          themed again. The cache is disabled by default.
+        * ``etags``, set to False to pass upstream ETags through unchanged.
+          By default themed responses get an ETag derived from the upstream
+          ETag and the compiled theme, and conditional requests for a page
+          already themed with the current theme are answered with a 304
+          without running the transform.
+        * ``feed_parser``, set to True to parse the upstream body as it
+          arrives instead of once it has been read completely, so that
+          parsing overlaps with a slow upstream
+        * ``stream_output``, set to True to send the themed page in chunks as
+          it is serialized, without a Content-Length
+        * ``compress_level``, a zlib compression level (1-9) to gzip or
+          deflate themed pages for clients that accept it. Off by default.
+          Compressed upstream responses are decompressed before theming
+          regardless of this setting.
+        * ``compress_min_size``, the size in bytes below which themed pages are
+          not compressed
+        * ``pool_size``, a number of worker processes to parse, transform and
+          serialize pages in, so that a threaded server can use all cores.
+          Compile eagerly when using this, so that the pool is started before
+          the server starts its threads.
+        * ``pool_timeout``, the number of seconds after which a page is themed
+          in the request thread if the pool has not returned it. Defaults to
+          30.
+        * ``thread_transforms``, set to False to share a single compiled
+          transform between all threads rather than building one per thread
         * ``notheme``, a list of regular expressions for paths which should
           not be themed.
         """
@@ -173,9 +1208,70 @@ class XDVMiddleware(object):
         self.read_network = read_network
         self.access_control = etree.XSLTAccessControl(read_file=True, write_file=False, create_dir=False, read_network=read_network, write_network=False)
         self.transform = None
+        
+        self.live_interval = float(live_interval)
+        self.watched = []
+        self.signature = None
+        self.last_check = 0
+        self.compile_lock = threading.Lock()
+        self.cache_dir = cache_dir
+        self.counters = Counters('notheme', 'extension')
+        self.transform_counters = Counters('instances', 'built', 'build_time')
+        self.include_resolver = None
+        if asbool(resolve_includes):
+            if include_timeout is not None:
+                include_timeout = float(include_timeout)
+            self.include_resolver = IncludeResolver(app,
+                    read_network=asbool(read_network),
+                    cache_size=int(include_cache_size or 0),
+                    timeout=include_timeout,
+                    max_threads=int(include_threads),
+                )
+        self.resolver = None
+        if int(resource_cache_size or 0) > 0 or asbool(resources_from_app):
+            self.resolver = CachingResolver(
+                    app=asbool(resources_from_app) and app or None,
+                    read_network=asbool(read_network),
+                    cache_size=int(resource_cache_size or 0),
+                    ttl=float(resource_ttl),
+                )
+        self.timings = None
+        if asbool(collect_timings) or timing_header:
+            self.timings = Histograms()
+        self.transform_options = dict(
+                max_body_size=max_body_size,
+                max_transform_time=max_transform_time,
+                max_concurrent=max_concurrent,
+                skeleton=skeleton,
+                profile_every=profile_every,
+                timing_header=timing_header,
+                stats_path=stats_path,
+                etags=etags,
+                feed_parser=feed_parser,
+                stream_output=stream_output,
+                compress_level=compress_level,
+                compress_min_size=compress_min_size,
+                pool_size=pool_size,
+                pool_timeout=pool_timeout,
+                thread_transforms=thread_transforms,
+            )
+        self.response_cache = None
+        if int(response_cache_size or 0) > 0:
+            self.response_cache = LRUCache(max_size=int(response_cache_size))
+        
+        if asbool(eager):
+            self.transform = self.get_transform()
     
     def compile_theme(self):        
         rules_parser = etree.XMLParser(recover=False)
+        parser = compiler_parser = None
+        if self.resolver is not None:
+            # the compiled theme ends up with the theme parser, so that one
+            # needs the resolver for document() too
+            parser = etree.HTMLParser()
+            compiler_parser = etree.XMLParser()
+            for p in (rules_parser, parser, compiler_parser):
+                p.resolvers.add(self.resolver)
         
         return compile_theme(self.rules, self.theme,
                 extra=self.extra,
@@ -184,22 +1280,177 @@ class XDVMiddleware(object):
                 absolute_prefix=self.absolute_prefix,
                 update=self.update,
                 includemode=self.includemode,
+                parser=parser,
+                compiler_parser=compiler_parser,
                 rules_parser=rules_parser,
                 access_control=self.access_control,
             )
     
+    def cache_key(self):
+        """Return a digest of everything that goes into the compiled theme
+        """
+        digest = hashlib.sha1()
+        try:
+            digest.update(pkg_resources.get_distribution('xdv').version)
+        except pkg_resources.DistributionNotFound:
+            pass
+        for name in ('css', 'xinclude', 'absolute_prefix', 'update', 'includemode'):
+            digest.update('\n%s=%r' % (name, getattr(self, name)))
+        for location in self.watched_locations():
+            digest.update('\n%s\n' % location)
+            digest.update(read_resource(location))
+        return digest.hexdigest()
+    
+    def compiled_theme(self):
+        """Return the compiled theme, from the cache directory if possible
+        """
+        if not self.cache_dir:
+            return self.compile_theme()
+        
+        path = os.path.join(self.cache_dir, '%s.xsl' % self.cache_key())
+        if os.path.exists(path):
+            try:
+                return etree.parse(path)
+            except (IOError, etree.XMLSyntaxError):
+                pass # recompile and overwrite it
+        
+        compiled = self.compile_theme()
+        
+        # Write to a temporary file first so that other processes never
+        # see a partially written stylesheet
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError:
+            if not os.path.isdir(self.cache_dir):
+                raise
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            os.write(fd, etree.tostring(compiled, encoding='utf-8'))
+        finally:
+            os.close(fd)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            os.remove(tmp_path) # Windows won't replace, someone else won
+        return compiled
+    
+    def watched_locations(self):
+        """Return the locations the compiled theme is built from
+        """
+        locations = [l for l in (self.rules, self.theme, self.extra) if l]
+        if self.rules and asbool(self.xinclude):
+            parser = etree.XMLParser(no_network=not asbool(self.read_network))
+            locations.extend(xinclude_locations(self.rules, parser))
+        return locations
+    
+    def get_signature(self, locations):
+        return [resource_signature(l) for l in locations]
+    
     def get_transform(self):
-        return XSLTMiddleware(self.app, self.global_conf,
+        if self.live:
+            # Take the signature before compiling so that a change made
+            # while we compile triggers another recompile
+            watched = self.watched_locations()
+            signature = self.get_signature(watched)
+        
+        start = time.time()
+        compiled = self.compiled_theme()
+        if self.timings is not None:
+            self.timings.record('compile', (time.time() - start) * 1000)
+        
+        transform = XSLTMiddleware(self.app, self.global_conf,
                 ignore_paths=self.notheme,
-                xslt_tree=self.compile_theme(),
+                xslt_tree=compiled,
                 read_network=self.read_network,
+                counters=self.counters,
+                response_cache=self.response_cache,
+                transform_counters=self.transform_counters,
+                include_resolver=self.include_resolver,
+                resolver=self.resolver,
+                timings=self.timings,
+                rules=self.rules,
+                **self.transform_options
             )
+        if self.response_cache is not None:
+            # Entries for the previous theme can never be hit again
+            self.response_cache.clear()
+        
+        if self.live:
+            self.watched = watched
+            self.signature = signature
+            self.last_check = time.time()
+        return transform
     
-    def __call__(self, environ, start_response):
+    def first_transform(self):
+        """Compile the theme for the first time. Concurrent requests wait for
+        a single compilation rather than each compiling their own copy.
+        """
+        self.compile_lock.acquire()
+        try:
+            if self.transform is None:
+                self.transform = self.get_transform()
+        finally:
+            self.compile_lock.release()
+        return self.transform
+    
+    def release(self, transform=None):
+        """Drop the compiled theme. It is compiled again on the next request.
+        With ``transform``, only drop that one: it may have been replaced by
+        a recompile already.
+        """
+        self.compile_lock.acquire()
+        try:
+            if transform is None:
+                transform = self.transform
+            if transform is self.transform:
+                self.transform = None
+        finally:
+            self.compile_lock.release()
+        if transform is not None:
+            transform.close()
+    
+    def check_transform(self):
+        """Recompile the theme if any of the watched resources has changed.
         
+        Only one thread checks and recompiles at a time; the others carry on
+        with the current transform, which is swapped out only once the new
+        one is ready.
+        """
+        if time.time() - self.last_check < self.live_interval:
+            return self.transform
+        if not self.compile_lock.acquire(False):
+            return self.transform
+        try:
+            self.last_check = time.time()
+            if self.get_signature(self.watched) != self.signature:
+                if self.resolver is not None:
+                    # don't compile from the copies of the old resources
+                    self.resolver.clear()
+                previous = self.transform
+                self.transform = self.get_transform()
+                previous.close()
+        finally:
+            self.compile_lock.release()
+        return self.transform
+    
+    def current_transform(self, environ):
+        """Return the ``XSLTMiddleware`` of the current compiled theme,
+        compiling the theme first if it is not ready or, in live mode, has
+        changed
+        """
         transform = self.transform
         if transform is None or self.live:
-            transform = self.get_transform()
-        if transform is not None and not self.live:
-            self.transform = transform
-        return transform(environ, start_response)
+            if self.resolver is not None:
+                previous = self.resolver.bind(environ)
+            try:
+                if transform is None:
+                    transform = self.first_transform()
+                else:
+                    transform = self.check_transform()
+            finally:
+                if self.resolver is not None:
+                    self.resolver.bind(*previous)
+        return transform
+    
+    def __call__(self, environ, start_response):
+        return self.current_transform(environ)(environ, start_response)
@@ -0,0 +1,229 @@
+import re
+import copy
+import urllib
+import urlparse
+
+from xml.sax.saxutils import escape, unescape
+
+from lxml import etree
+from lxml import html
+
+from paste.request import construct_url
+from paste.response import header_value
+
+from dv.xdvserver.cache import LRUCache
+from dv.xdvserver.encoding import decompressing
+from dv.xdvserver.fetch import fetch_all, has_credentials, is_same_origin, max_age
+from dv.xdvserver.stats import Counters
+
+ESI_NAMESPACE = 'http://www.edge-delivery.org/esi/1.0'
+
+# The includes written by the xdv compiler with includemode 'esi' or 'ssi',
+# which writes ``<!--# include  virtual="..." wait="yes" -->``
+INCLUDES_XPATH = etree.XPath(
+    "//esi:include[@src] | "
+    "//comment()[starts-with(translate(normalize-space(.), ' ', ''), '#include')]",
+    namespaces={'esi': ESI_NAMESPACE})
+SSI_VIRTUAL = re.compile(r'''^\s*#\s*include\s+virtual=(?:"([^"]*)"|'([^']*)')''')
+
+# The same, once serialized
+SERIALIZED_INCLUDE = re.compile(
+    r'''<esi:include\s+src=(?:"([^"]*)"|'([^']*)')\s*(?:/>|>\s*</esi:include>)'''
+    r'''|<!--\s*#\s*include\s+virtual=(?:"([^"]*)"|'([^']*)')[^>]*?-->''')
+
+FILTER_XPATH = ';filter_xpath='
+
+
+def split_include(src):
+    """Split the URL of an include, as written by the xdv compiler, into the
+    URL to fetch and the XPath expression selecting the fragment (or None)
+    """
+    if FILTER_XPATH not in src:
+        return src, None
+    url, xpath = src.split(FILTER_XPATH, 1)
+    if url.endswith('?'):
+        url = url[:-1]
+    return url, urllib.unquote(xpath)
+
+
+def include_src(node):
+    """Return the URL of an ESI include element or SSI include comment
+    """
+    if node.tag is etree.Comment:
+        match = SSI_VIRTUAL.match(node.text or '')
+        if match is None:
+            return None
+        return match.group(1) or match.group(2)
+    return node.get('src')
+
+
+def replace_node(node, items):
+    """Replace ``node`` by ``items``, a list of elements and strings,
+    keeping the text that followed it
+    """
+    parent = node.getparent()
+    if parent is None:
+        return
+    index = parent.index(node)
+    previous = node.getprevious()
+    items = list(items)
+    if node.tail:
+        items.append(node.tail)
+    parent.remove(node)
+
+    for item in items:
+        if isinstance(item, basestring):
+            if previous is None:
+                parent.text = (parent.text or '') + item
+            else:
+                previous.tail = (previous.tail or '') + item
+        else:
+            element = copy.deepcopy(item)
+            element.tail = None
+            parent.insert(index, element)
+            index += 1
+            previous = element
+
+
+def serialize_items(items):
+    pieces = []
+    for item in items:
+        if isinstance(item, basestring):
+            pieces.append(escape(item).encode('ascii', 'xmlcharrefreplace'))
+        else:
+            pieces.append(html.tostring(item, with_tail=False))
+    return ''.join(pieces)
+
+
+class IncludeResolver(object):
+    """Resolve the ESI and SSI includes in a themed page, fetching all the
+    fragments of a page in parallel. Fragments on the same host as the page
+    are requested from the wrapped application directly; others are fetched
+    over the network if ``read_network`` is set.
+
+    With a ``cache_size``, fetched fragments are kept for as long as their
+    Cache-Control header allows. Fragments requested from the application
+    with the user's cookies or authorization are only kept if they are
+    ``public`` or have an ``s-maxage``, as they are cached by URL alone.
+    """
+
+    def __init__(self, app, read_network=False, cache_size=0, timeout=None,
+                 max_threads=10):
+        self.app = app
+        self.read_network = read_network
+        self.timeout = timeout
+        self.max_threads = max_threads
+        self.cache = None
+        if cache_size:
+            self.cache = LRUCache(max_size=cache_size)
+        self.counters = Counters('includes', 'fetched', 'errors')
+
+    def fragments(self, environ, srcs):
+        """Return a dict from each include URL in ``srcs`` to the list of
+        elements and strings to put in its place
+        """
+        base = construct_url(environ)
+        targets = {}
+        for src in srcs:
+            url, xpath = split_include(src)
+            targets[src] = (urlparse.urljoin(base, url), xpath)
+
+        bodies = {}
+        missing = set()
+        for url, xpath in targets.values():
+            if url in bodies or url in missing:
+                continue
+            body = None
+            if self.cache is not None:
+                body = self.cache.get(url)
+            if body is None:
+                missing.add(url)
+            else:
+                bodies[url] = body
+
+        results = fetch_all(self.app, environ, missing, self.read_network,
+                            self.timeout, self.max_threads)
+        for url, (status, headers, body) in results.items():
+            self.counters.increment('fetched')
+            if not status.startswith('200'):
+                self.counters.increment('errors')
+                bodies[url] = ''
+                continue
+            coding = (header_value(headers, 'content-encoding') or '').lower()
+            if coding in ('gzip', 'x-gzip', 'deflate'):
+                body = ''.join(decompressing([body], coding.replace('x-', '')))
+            bodies[url] = body
+            credentials = is_same_origin(environ, url) and has_credentials(environ)
+            ttl = max_age(headers, credentials)
+            if self.cache is not None and ttl and not header_value(headers, 'set-cookie'):
+                self.cache.set(url, body, ttl=ttl)
+
+        fragments = {}
+        for src, (url, xpath) in targets.items():
+            fragments[src] = self.select(bodies[url], xpath)
+        return fragments
+
+    def select(self, body, xpath):
+        """Parse a fragment response and return the items it contributes
+        """
+        if not body.strip():
+            return []
+        document = etree.fromstring(body, parser=etree.HTMLParser())
+        if document is None:
+            return []
+        if xpath:
+            result = document.xpath(xpath)
+            if not isinstance(result, list):
+                return [unicode(result)]
+            return result
+        container = document.find('body')
+        if container is None:
+            container = document
+        items = []
+        if container.text:
+            items.append(container.text)
+        for child in container:
+            items.append(child)
+            if child.tail:
+                items.append(child.tail)
+        return items
+
+    def resolve_tree(self, environ, tree):
+        """Replace the includes in the document ``tree``
+        """
+        nodes = [(node, include_src(node)) for node in INCLUDES_XPATH(tree)]
+        nodes = [(node, src) for node, src in nodes if src]
+        if not nodes:
+            return tree
+        self.counters.increment('includes', len(nodes))
+        fragments = self.fragments(environ, set([src for node, src in nodes]))
+        for node, src in nodes:
+            replace_node(node, fragments[src])
+        etree.cleanup_namespaces(tree)
+        return tree
+
+    def resolve_string(self, environ, body):
+        """Replace the includes in the serialized page ``body``
+        """
+        matches = list(SERIALIZED_INCLUDE.finditer(body))
+        if not matches:
+            return body
+        srcs = [unescape([g for g in match.groups() if g is not None][0],
+                         {'&quot;': '"', '&#39;': "'"})
+                for match in matches]
+        self.counters.increment('includes', len(matches))
+        fragments = self.fragments(environ, set(srcs))
+        pieces = []
+        last = 0
+        for match, src in zip(matches, srcs):
+            pieces.append(body[last:match.start()])
+            pieces.append(serialize_items(fragments[src]))
+            last = match.end()
+        pieces.append(body[last:])
+        return ''.join(pieces)
+
+    def stats(self):
+        stats = self.counters.snapshot()
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        return stats
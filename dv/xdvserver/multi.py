@@ -0,0 +1,162 @@
+import json
+import logging
+import os.path
+import ConfigParser
+
+from dv.xdvserver.cache import LRUCache
+from dv.xdvserver.filter import XDVMiddleware
+from dv.xdvserver.stats import Counters
+
+logger = logging.getLogger('dv.xdvserver')
+
+
+def read_themes(filename):
+    """Read a theme mapping file. Each section describes one theme: ``host``
+    and ``path`` give the host names and path prefixes (one per line) it is
+    used for, and the remaining options are passed to ``XDVMiddleware``. The
+    ``[DEFAULT]`` section holds options shared by all themes, and
+    ``%(here)s`` is the directory of the file.
+
+    Returns a list of ``(name, hosts, paths, options)`` tuples.
+    """
+    parser = ConfigParser.ConfigParser({'here': os.path.dirname(os.path.abspath(filename))})
+    parser.read(filename)
+    themes = []
+    for name in parser.sections():
+        options = dict(parser.items(name))
+        del options['here']
+        hosts = [h.strip().lower() for h in options.pop('host', '').split() if h.strip()]
+        paths = [p.strip() for p in options.pop('path', '').split() if p.strip()]
+        themes.append((name, hosts, paths, options))
+    return themes
+
+
+class MultiThemeMiddleware(object):
+    """Theme each request with one of several xdv themes, chosen by the
+    request's host name and path
+    """
+
+    def __init__(self, app, global_conf, themes=None, max_themes=None,
+                 max_size=None, stats_path=None, **options):
+        """Create the middleware. The parameters are:
+
+        * ``themes``, the theme mapping file (see ``read_themes``)
+        * ``max_themes``, the maximum number of themes to keep compiled.
+          Themes are compiled when they are first used, and the least recently
+          used ones are dropped to make room.
+        * ``max_size``, the maximum total size in bytes of the compiled themes
+          to keep. A theme larger than that is compiled for each request
+          and dropped again.
+        * ``stats_path``, a path at which the middleware answers with the
+          statistics of every theme as JSON
+
+        Any other option is passed to the ``XDVMiddleware`` of every theme,
+        unless the mapping file overrides it.
+        """
+        self.app = app
+        self.global_conf = global_conf
+
+        if max_themes is not None:
+            max_themes = int(max_themes)
+        if max_size is not None:
+            max_size = int(max_size)
+        self.compiled = LRUCache(max_size=max_size, max_items=max_themes,
+                                 on_evict=self.evicted)
+        self.counters = Counters()
+        self.oversized = Counters()
+        self.stats_path = stats_path or None
+
+        self.middlewares = {}
+        self.selectors = []
+        for name, hosts, paths, theme_options in read_themes(themes):
+            theme_options = dict(options, **theme_options)
+            # compile on first use, as we may never need this theme
+            theme_options['eager'] = False
+            self.middlewares[name] = XDVMiddleware(app, global_conf, **theme_options)
+            self.selectors.append((hosts, paths, name))
+
+        # the most specific selectors first: a host name beats no host name,
+        # a longer path prefix beats a shorter one
+        def specificity(selector):
+            hosts, paths, name = selector
+            return (bool(hosts), max([len(p) for p in paths] or [0]))
+        self.selectors.sort(key=specificity, reverse=True)
+
+    def select(self, environ):
+        """Return the name of the theme for this request, or None
+        """
+        host = environ.get('HTTP_HOST') or environ.get('SERVER_NAME', '')
+        host = host.split(':')[0].lower()
+        path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        for hosts, paths, name in self.selectors:
+            if hosts and host not in hosts:
+                continue
+            if paths and not [p for p in paths if path.startswith(p)]:
+                continue
+            return name
+        return None
+
+    def evicted(self, name, transform):
+        self.middlewares[name].release(transform)
+
+    def __call__(self, environ, start_response):
+        if self.stats_path is not None and environ.get('PATH_INFO') == self.stats_path:
+            return self.stats_app(environ, start_response)
+
+        name = self.select(environ)
+        if name is None:
+            return self.app(environ, start_response)
+
+        self.counters.increment(name)
+        middleware = self.middlewares[name]
+        # Each request uses the transform it looked up, even if that is
+        # evicted meanwhile: what is compiled is always in the cache
+        transform = self.compiled.get(name)
+        if transform is None or middleware.live:
+            current = middleware.current_transform(environ)
+            if current is not transform:
+                transform = current
+                if not self.compiled.set(name, transform, size=len(transform.stylesheet)):
+                    self.too_large(name, middleware, transform)
+        return transform(environ, start_response)
+
+    def too_large(self, name, middleware, transform):
+        """Drop a compiled theme larger than ``max_size``, which would break
+        the bound if it was kept. The request it was compiled for still uses
+        it.
+        """
+        if not self.oversized[name]:
+            logger.warning("The compiled theme %s is larger than max_size, "
+                           "compiling it for every request" % name)
+        self.oversized.increment(name)
+        middleware.release(transform)
+
+    def stats(self):
+        """Return the request count of each theme, whether it is compiled,
+        how often it was dropped for being larger than ``max_size``, the
+        statistics of its filter while it is compiled, and the statistics
+        of the compiled theme cache
+        """
+        requests = self.counters.snapshot()
+        oversized = self.oversized.snapshot()
+        compiled = self.compiled.keys()
+        themes = {}
+        for name in self.middlewares:
+            themes[name] = {
+                'requests': requests.get(name, 0),
+                'compiled': name in compiled,
+                'oversized': oversized.get(name, 0),
+            }
+            transform = self.compiled.peek(name)
+            if transform is not None:
+                themes[name]['filter'] = transform.stats()
+        return {'themes': themes, 'compiled': self.compiled.stats()}
+
+    def stats_app(self, environ, start_response):
+        """Answer with the statistics as JSON
+        """
+        body = json.dumps(self.stats(), sort_keys=True, indent=2)
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body))),
+                                  ('Cache-Control', 'no-cache')])
+        return [body]
@@ -0,0 +1,117 @@
+import logging
+import threading
+import multiprocessing
+
+from lxml import etree
+from lxml import html
+
+from dv.xdvserver.stats import Counters
+
+logger = logging.getLogger('dv.xdvserver')
+
+# Seconds to wait for a worker: a worker that dies takes the page it was
+# given with it, and nothing else ever answers for that page
+POOL_TIMEOUT = 30
+
+# The compiled transform of a worker process
+_transform = None
+
+
+def _initialize(stylesheet, read_network):
+    global _transform
+    access_control = etree.XSLTAccessControl(read_file=True, write_file=False, create_dir=False, read_network=read_network, write_network=False)
+    _transform = etree.XSLT(etree.fromstring(stylesheet), access_control=access_control)
+
+
+def _apply(body):
+    # Errors are returned rather than raised, as not all of them survive
+    # pickling, and they must not be mistaken for a failure of the pool
+    try:
+        content = etree.fromstring(body, parser=etree.HTMLParser())
+        return True, html.tostring(_transform(content))
+    except Exception as e:
+        return False, '%s: %s' % (e.__class__.__name__, e)
+
+
+class TransformError(Exception):
+    """A worker process could not theme a page
+    """
+
+
+class TransformPool(object):
+    """A pool of worker processes that parse, transform and serialize pages
+    with their own copy of a compiled theme, so that a threaded server can
+    theme on all cores.
+
+    After ``max_failures`` timeouts or broken workers in a row, the pool is
+    replaced by a new one.
+    """
+
+    def __init__(self, stylesheet, read_network=False, processes=None,
+                 timeout=POOL_TIMEOUT, max_failures=3):
+        self.stylesheet = stylesheet
+        self.read_network = read_network
+        self.processes = processes
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.failures = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.counters = Counters('transforms', 'errors', 'timeouts', 'failures', 'restarts')
+        self.pool = self.start()
+
+    def start(self):
+        return multiprocessing.Pool(self.processes, _initialize,
+                                    (self.stylesheet, self.read_network))
+
+    def __call__(self, body):
+        """Return the themed and serialized ``body``. Raises
+        ``multiprocessing.TimeoutError`` if the pool took too long, or
+        ``TransformError`` if the page could not be themed.
+        """
+        if self.closed:
+            raise TransformError("The pool is closed")
+        pool = self.pool
+        try:
+            ok, result = pool.apply_async(_apply, (body,)).get(self.timeout)
+        except multiprocessing.TimeoutError:
+            self.counters.increment('timeouts')
+            self.failed(pool)
+            raise
+        except Exception:
+            self.counters.increment('failures')
+            self.failed(pool)
+            raise
+        # the pool is fine, even if the page is not
+        self.failures = 0
+        if not ok:
+            self.counters.increment('errors')
+            raise TransformError(result)
+        self.counters.increment('transforms')
+        return result
+
+    def failed(self, pool):
+        self.lock.acquire()
+        try:
+            self.failures += 1
+            if (self.failures < self.max_failures or pool is not self.pool or
+                    self.closed):
+                return
+            logger.warning("Restarting the transform pool after %d failures" % self.failures)
+            self.pool = self.start()
+            self.failures = 0
+            self.counters.increment('restarts')
+        finally:
+            self.lock.release()
+        pool.terminate()
+
+    def close(self):
+        """Let the workers finish the pages they were given, then exit
+        """
+        self.closed = True
+        self.pool.close()
+
+    def stats(self):
+        stats = self.counters.snapshot()
+        stats['processes'] = self.processes or multiprocessing.cpu_count()
+        return stats
@@ -0,0 +1,177 @@
+import threading
+import urlparse
+
+from lxml import etree
+from xdv.cssrules import convert_css_selectors
+
+XSL_NAMESPACE = 'http://www.w3.org/1999/XSL/Transform'
+RULES_NAMESPACES = ('http://namespaces.plone.org/xdv', 'http://openplans.org/deliverance')
+CSS_NAMESPACE = 'http://namespaces.plone.org/xdv+css'
+XINCLUDE_NAMESPACE = 'http://www.w3.org/2001/XInclude'
+
+# libxslt measures time in ticks of 10 microseconds
+TICKS_PER_MS = 100.0
+
+
+def template_key(match, name, mode):
+    return (match or '', name or '', mode or '')
+
+
+def describe_rule(element, location=None):
+    """Return a short description of a rule element, e.g.
+    ``rules.xml:12 <drop css:content="#portal-footer"/>``
+    """
+    attributes = []
+    for name, value in element.attrib.items():
+        if name.startswith('{%s}' % CSS_NAMESPACE):
+            name = 'css:' + name.split('}', 1)[1]
+        elif name.startswith('{'):
+            continue
+        attributes.append(' %s="%s"' % (name, value))
+    description = '<%s%s/>' % (etree.QName(element).localname, ''.join(attributes))
+    if location:
+        description = '%s:%s %s' % (location, element.sourceline, description)
+    return description
+
+
+def rule_origins(rules):
+    """Return a list of the name of each rule in the ``rules`` file and the
+    files it XIncludes, the XPath expression of its content, as the compiler
+    writes it, and a description of the rule
+    """
+    try:
+        tree = etree.parse(rules)
+    except (IOError, etree.XMLSyntaxError):
+        return []
+    # describe the rules as written, before their selectors are converted,
+    # and where they were written, which XInclude does not keep
+    found = []
+    for element in tree.iter(etree.Element):
+        if element.tag == '{%s}include' % XINCLUDE_NAMESPACE and element.get('href'):
+            found.append(rule_origins(urlparse.urljoin(rules, element.get('href'))))
+        elif etree.QName(element).namespace in RULES_NAMESPACES:
+            found.append((element, describe_rule(element, rules)))
+    convert_css_selectors(tree)
+    origins = []
+    for item in found:
+        if isinstance(item, list):
+            origins.extend(item)
+            continue
+        element, description = item
+        content = element.get('content')
+        if content:
+            origins.append((etree.QName(element).localname, content, description))
+    return origins
+
+
+def template_origins(stylesheet, rules=None):
+    """Return a dict from the key of each template of the compiled theme
+    ``stylesheet``, given as a string, to what it was generated from.
+
+    xdv passes the content through its ``initial-stage`` templates, which
+    drop content, into the theme in the ``apply-theme`` template, where the
+    other rules copy content, and the result through its ``final-stage``
+    templates. libxslt leaves the empty templates of drop rules out of its
+    profile, so matching them counts against the initial stage.
+    """
+    root = etree.fromstring(stylesheet)
+    origins = []
+    if rules:
+        origins = rule_origins(rules)
+    drops = [(content, description) for name, content, description in origins
+             if name == 'drop']
+
+    result = {}
+    for template in root.iterchildren('{%s}template' % XSL_NAMESPACE):
+        match = template.get('match')
+        mode = template.get('mode')
+        key = template_key(match, template.get('name'), mode)
+        if match == '/' and not mode:
+            result[key] = 'initial-stage, apply-theme and final-stage passes'
+        elif mode == 'apply-theme':
+            selects = set([element.get('select') for element in template.iter()
+                           if element.get('select')])
+            copied = [description for name, content, description in origins
+                      if name != 'drop' and content in selects]
+            result[key] = '; '.join(['theme'] + copied)
+        elif mode == 'initial-stage' and match in dict(drops):
+            result[key] = dict(drops)[match]
+        elif mode == 'initial-stage' and match == 'node()|@*':
+            result[key] = '; '.join(['content copied through the initial stage']
+                                    + [description for content, description in drops])
+        elif mode == 'initial-stage':
+            result[key] = 'content filtered in the initial stage'
+        elif mode == 'final-stage':
+            result[key] = 'themed page copied through the final stage'
+    return result
+
+
+class TemplateProfile(object):
+    """Aggregates the profiles of sampled transforms, as produced by running
+    an ``etree.XSLT`` with ``profile_run=True``, per template of the compiled
+    theme, given as a string. ``rules`` is the rules file the theme was
+    compiled from, to tell which rule each template comes from.
+    """
+
+    def __init__(self, stylesheet, rules=None):
+        self.stylesheet = stylesheet
+        self.rules = rules
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.templates = {}
+        self.origins = None
+
+    def add(self, profile, previous):
+        """Add the ``xslt_profile`` of a transform result. libxslt keeps
+        adding up the profiles of an ``etree.XSLT``, so ``previous`` is a
+        dict holding the last totals of that ``etree.XSLT``, which is
+        updated to the new ones.
+        """
+        self.lock.acquire()
+        try:
+            self.runs += 1
+            # the profile document is not built by a parser, so find its
+            # elements without asking lxml to match their tag names
+            for template in profile.getroot():
+                key = template_key(template.get('match'), template.get('name'),
+                                   template.get('mode'))
+                calls = int(template.get('calls', 0))
+                ticks = int(template.get('time', 0))
+                last_calls, last_ticks = previous.get(key, (0, 0))
+                previous[key] = (calls, ticks)
+                totals = self.templates.setdefault(key, [0, 0])
+                totals[0] += calls - last_calls
+                totals[1] += ticks - last_ticks
+        finally:
+            self.lock.release()
+
+    def report(self, limit=None):
+        """Return the templates, most expensive first, with their total
+        number of calls, their total time and mean time per sampled
+        transform in milliseconds, and their origin
+        """
+        if self.origins is None:
+            self.origins = template_origins(self.stylesheet, self.rules)
+        self.lock.acquire()
+        try:
+            runs = self.runs
+            templates = [(key, tuple(totals)) for key, totals in self.templates.items()]
+        finally:
+            self.lock.release()
+
+        report = []
+        for key, (calls, ticks) in templates:
+            match, name, mode = key
+            report.append({
+                'match': match,
+                'name': name,
+                'mode': mode,
+                'calls': calls,
+                'time': ticks / TICKS_PER_MS,
+                'time_per_run': runs and ticks / TICKS_PER_MS / runs or 0,
+                'origin': self.origins.get(key),
+            })
+        report.sort(key=lambda template: template['time'], reverse=True)
+        if limit is not None:
+            report = report[:limit]
+        return report
@@ -0,0 +1,116 @@
+import urlparse
+import threading
+
+from lxml import etree
+
+from paste.response import header_value
+
+from dv.xdvserver.cache import LRUCache
+from dv.xdvserver.encoding import decompressing
+from dv.xdvserver.fetch import fetch_app, fetch_url, has_credentials, is_same_origin, max_age
+from dv.xdvserver.stats import Counters
+
+
+class CachingResolver(etree.Resolver):
+    """An lxml resolver for the HTTP URLs of the theme, the rules, the extra
+    file and the targets of ``document()`` in the compiled theme.
+
+    Resources are kept in an LRU cache of ``cache_size`` bytes for as long as
+    their Cache-Control header allows, or ``ttl`` seconds if they have none.
+    With ``app``, URLs on the same host as the current request are requested
+    from that WSGI application directly instead of over the network; these
+    are only cached if their Cache-Control header says so, as they are
+    rendered for the user making the request, and if the request has cookies
+    or authorization, only if they are ``public`` or have an ``s-maxage``.
+    Other URLs are fetched over the network if ``read_network`` is set.
+
+    Anything this resolver does not handle is left to libxml2.
+    """
+
+    def __init__(self, app=None, read_network=False, cache_size=0, ttl=300,
+                 timeout=None):
+        etree.Resolver.__init__(self)
+        self.app = app
+        self.read_network = read_network
+        self.ttl = ttl
+        self.timeout = timeout
+        self.cache = None
+        if cache_size:
+            self.cache = LRUCache(max_size=cache_size)
+        self.local = threading.local()
+        self.counters = Counters('requests', 'fetched', 'from_app', 'errors')
+
+    def bind(self, environ, base_url=None):
+        """Make ``environ`` the request of the current thread, so that URLs
+        on its host are requested from the application. URLs without a
+        scheme are resolved against ``base_url``, if given. Returns the
+        arguments that were bound before, to bind again afterwards.
+        """
+        previous = (getattr(self.local, 'environ', None),
+                    getattr(self.local, 'base_url', None))
+        self.local.environ = environ
+        self.local.base_url = base_url
+        return previous
+
+    def resolve(self, url, pubid, context):
+        base_url = getattr(self.local, 'base_url', None)
+        if base_url is not None and not urlparse.urlparse(url)[0]:
+            url = urlparse.urljoin(base_url, url)
+        if urlparse.urlparse(url)[0] not in ('http', 'https'):
+            return None
+        self.counters.increment('requests')
+        body = None
+        if self.cache is not None:
+            body = self.cache.get(url)
+        if body is None:
+            body = self.fetch(url)
+            if body is None:
+                return None
+        return self.resolve_string(body, context, base_url=url)
+
+    def fetch(self, url):
+        """Fetch ``url`` and cache it if allowed. Returns the body, or None
+        if it could not be fetched.
+        """
+        environ = getattr(self.local, 'environ', None)
+        from_app = (self.app is not None and environ is not None and
+                    is_same_origin(environ, url))
+        if not (from_app or self.read_network):
+            return None
+        try:
+            if from_app:
+                self.counters.increment('from_app')
+                status, headers, body = fetch_app(self.app, environ, url)
+            else:
+                status, headers, body = fetch_url(url, self.timeout)
+        except Exception:
+            self.counters.increment('errors')
+            return None
+        self.counters.increment('fetched')
+        if not status.startswith('200'):
+            self.counters.increment('errors')
+            return None
+
+        coding = (header_value(headers, 'content-encoding') or '').lower()
+        if coding in ('gzip', 'x-gzip', 'deflate'):
+            body = ''.join(decompressing([body], coding.replace('x-', '')))
+
+        if self.cache is not None and not header_value(headers, 'set-cookie'):
+            ttl = max_age(headers, from_app and has_credentials(environ))
+            if ttl is None and not from_app and not header_value(headers, 'cache-control'):
+                ttl = self.ttl
+            if ttl:
+                self.cache.set(url, body, ttl=ttl)
+        return body
+
+    def clear(self):
+        if self.cache is not None:
+            self.cache.clear()
+
+    def stats(self):
+        stats = self.counters.snapshot()
+        if self.cache is not None:
+            cache = stats['cache'] = self.cache.stats()
+            lookups = cache['hits'] + cache['misses']
+            stats['hit_rate'] = lookups and float(cache['hits']) / lookups or 0.0
+        return stats
@@ -0,0 +1,79 @@
+from lxml import etree
+from lxml import html
+
+CHUNK_SIZE = 16384
+SPLIT_DEPTH = 3
+
+
+def serialize_chunks(tree, chunk_size=CHUNK_SIZE, depth=SPLIT_DEPTH):
+    """Serialize a document as HTML like ``lxml.html.tostring``, but as an
+    iterator of chunks of about ``chunk_size`` bytes. Elements up to
+    ``depth`` levels below the root are serialized one at a time, so the
+    first chunk is ready long before the whole document has been serialized.
+    """
+    buffer = []
+    size = 0
+    for piece in _document_pieces(tree, depth):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def _document_pieces(tree, depth):
+    if not hasattr(tree, 'getroot'):
+        tree = tree.getroottree()
+    root = tree.getroot()
+    if root is None:
+        return
+    doctype = tree.docinfo.doctype
+    if doctype:
+        # lxml gives it as unicode, html.tostring() gives ASCII
+        yield doctype.encode('ascii', 'xmlcharrefreplace') + '\n'
+    preceding = list(root.itersiblings(preceding=True))
+    preceding.reverse()
+    for sibling in preceding:
+        yield html.tostring(sibling, with_tail=False)
+    for piece in _element_pieces(root, depth):
+        yield piece
+    for sibling in root.itersiblings():
+        yield html.tostring(sibling, with_tail=False)
+
+
+def _element_pieces(element, depth):
+    tag = element.tag
+    if (depth <= 0 or len(element) == 0 or not isinstance(tag, basestring)
+            or tag.startswith('{')):
+        yield html.tostring(element, with_tail=False)
+        return
+
+    # Let lxml serialize the start tag (and the text) from a childless copy
+    shallow = etree.Element(tag, dict(element.attrib))
+    shallow.text = element.text
+    start = html.tostring(shallow)
+    end = '</%s>' % tag
+    if start.endswith(end):
+        start = start[:-len(end)]
+    yield start
+
+    for child in element:
+        for piece in _element_pieces(child, depth - 1):
+            yield piece
+        if child.tail:
+            yield serialize_text(tag, child.tail)
+    yield end
+
+
+def serialize_text(tag, text):
+    """Serialize ``text`` as ``lxml.html.tostring`` would inside a ``tag``
+    element. Let lxml escape it, as how it writes character references
+    differs between versions.
+    """
+    holder = etree.Element(tag)
+    holder.text = text
+    serialized = html.tostring(holder)
+    return serialized[len('<%s>' % tag):-len('</%s>' % tag)]
@@ -0,0 +1,208 @@
+"""Pre-rendered skeletons of compiled themes.
+
+Most of a themed page is the theme itself, the same on every page. For a
+compiled theme whose only instructions are the ``xsl:apply-templates`` and
+``xsl:copy-of`` of its rules, the theme is serialized once, and each page
+only evaluates those instructions and splices their results in between.
+The passes xdv compiles over the content before the theme and over the
+themed page after it still run on every page, on the regions alone.
+"""
+
+import re
+import logging
+
+from lxml import etree
+from lxml import html
+
+from dv.xdvserver.serialize import serialize_text
+
+logger = logging.getLogger('dv.xdvserver')
+
+XSL_NAMESPACE = 'http://www.w3.org/1999/XSL/Transform'
+
+# The instructions that put content into the theme
+REGION_INSTRUCTIONS = ('{%s}apply-templates' % XSL_NAMESPACE, '{%s}copy-of' % XSL_NAMESPACE)
+
+# Elements whose content the HTML serializer does not escape
+RAW_TEXT_ELEMENTS = ('script', 'style')
+
+MARKER = 'xdv-region-%d'
+REGIONS = 'xdv-regions'
+REGION = 'xdv-region'
+
+
+class Unsplittable(Exception):
+    """The compiled theme does more than put content into the theme
+    """
+
+
+def xsl(name):
+    return '{%s}%s' % (XSL_NAMESPACE, name)
+
+
+def top_level_steps(expression):
+    """Return the last location step of each branch of the union
+    ``expression``, without its predicates
+    """
+    depth = 0
+    stripped = []
+    for char in expression:
+        if char in '[(':
+            depth += 1
+        elif char in '])':
+            depth -= 1
+        elif depth == 0:
+            stripped.append(char)
+    return [re.split(r'/', branch)[-1].strip() for branch in ''.join(stripped).split('|')]
+
+
+def may_select_attributes(expression):
+    """Tell whether the node-set ``expression`` may select attributes, which
+    would be set on the element the instruction is in rather than be
+    inserted into its content
+    """
+    for step in top_level_steps(expression):
+        if step.startswith('@') or step.startswith('attribute::') or step.startswith('$'):
+            return True
+    return False
+
+
+def theme_template(root):
+    """Return the template with the theme of a compiled theme, which the
+    template matching the root applies, between the passes over the content
+    before and the themed page after it that xdv compiles
+    """
+    for element in root:
+        if element.tag in (xsl('import'), xsl('include')):
+            raise Unsplittable("it imports or includes stylesheets")
+    roots = [t for t in root.iterchildren(xsl('template'))
+             if t.get('match') == '/' and not t.get('mode')]
+    if len(roots) != 1:
+        raise Unsplittable("it has %d templates matching the root" % len(roots))
+    # the passes are variables holding what a mode makes of the previous one
+    modes = set()
+    for element in roots[0].iter(etree.Element):
+        if element is roots[0] or element.tag == xsl('variable'):
+            if (element.text or '').strip():
+                raise Unsplittable("its root template writes text")
+        elif element.tag == xsl('apply-templates') and not len(element):
+            modes.add(element.get('mode'))
+        else:
+            raise Unsplittable("it chooses between several themes")
+        if (element.tail or '').strip() and element is not roots[0]:
+            raise Unsplittable("its root template writes text")
+    themes = [t for t in root.iterchildren(xsl('template'))
+              if t.get('match') == '/' and t.get('mode') and t.get('mode') in modes]
+    if len(themes) != 1:
+        raise Unsplittable("it has %d theme templates" % len(themes))
+    return themes[0]
+
+
+def theme_regions(template):
+    """Return the instructions of the theme ``template`` that put content
+    into the theme, in document order
+    """
+    literals = list(template.iterchildren(etree.Element))
+    if len(literals) != 1 or etree.QName(literals[0]).namespace == XSL_NAMESPACE:
+        raise Unsplittable("its theme is not a single element")
+    if (template.text or '').strip() or (literals[0].tail or '').strip():
+        raise Unsplittable("its theme has text outside the root element")
+
+    regions = []
+    for element in literals[0].iter():
+        if not isinstance(element.tag, basestring):
+            continue # comments are not copied from the stylesheet
+        if element.tag in REGION_INSTRUCTIONS:
+            if len(element):
+                raise Unsplittable("an instruction has parameters or sorts")
+            if may_select_attributes(element.get('select', 'node()')):
+                raise Unsplittable("%s may select attributes" % element.get('select'))
+            for ancestor in element.iterancestors():
+                if ancestor.tag in RAW_TEXT_ELEMENTS:
+                    raise Unsplittable("content is put into a <%s>" % ancestor.tag)
+            regions.append(element)
+            continue
+        if etree.QName(element).namespace == XSL_NAMESPACE:
+            raise Unsplittable("its theme uses <xsl:%s>" % etree.QName(element).localname)
+        for name, value in element.attrib.items():
+            if '{' in value or name.startswith('{%s}' % XSL_NAMESPACE):
+                raise Unsplittable("<%s> has a computed attribute" % element.tag)
+    return regions
+
+
+class Skeleton(object):
+    """The static parts of a theme, serialized, and a stylesheet producing
+    the content of the regions in between: an element wrapping one element
+    per region.
+    """
+
+    def __init__(self, stylesheet, pieces):
+        self.stylesheet = stylesheet
+        self.pieces = pieces
+
+    def chunks(self, result):
+        """Yield the themed page in chunks, given the ``result`` of the
+        regions stylesheet
+        """
+        yield self.pieces[0]
+        # The stylesheet's namespace declarations are written onto the
+        # region elements, and would be serialized with their children
+        etree.cleanup_namespaces(result)
+        for region, piece in zip(result.getroot(), self.pieces[1:]):
+            if region.text:
+                yield serialize_text('div', region.text)
+            for child in region:
+                yield html.tostring(child)
+            yield piece
+
+    def serialize(self, result):
+        return ''.join(self.chunks(result))
+
+
+def split_theme(stylesheet):
+    """Return the ``Skeleton`` of the compiled theme ``stylesheet``, given as
+    a string, or None if it does more than put content into the theme.
+    """
+    try:
+        return Skeleton(*split(stylesheet))
+    except Unsplittable as e:
+        logger.info("Running the whole compiled theme on every page, as %s" % e)
+        return None
+
+
+def split(stylesheet):
+    # the skeleton, with a marker comment in place of each region
+    root = etree.fromstring(stylesheet)
+    regions = theme_regions(theme_template(root))
+    for number, region in enumerate(regions):
+        marker = etree.Element(xsl('comment'))
+        marker.text = MARKER % number
+        marker.tail = region.tail
+        region.getparent().replace(region, marker)
+    try:
+        skeleton = html.tostring(etree.XSLT(root)(etree.fromstring('<html/>')))
+    except (etree.XSLTParseError, etree.XSLTApplyError) as e:
+        raise Unsplittable("its theme could not be rendered: %s" % e)
+
+    pieces = []
+    for number in range(len(regions)):
+        marker = '<!--%s-->' % (MARKER % number)
+        if skeleton.count(marker) != 1:
+            raise Unsplittable("its theme could not be serialized around its regions")
+        piece, skeleton = skeleton.split(marker)
+        pieces.append(piece)
+    pieces.append(skeleton)
+
+    # the regions alone, in place of the theme
+    root = etree.fromstring(stylesheet)
+    template = theme_template(root)
+    regions = theme_regions(template)
+    wrapper = etree.Element(REGIONS)
+    for region in regions:
+        region.tail = None
+        etree.SubElement(wrapper, REGION).append(region)
+    for child in list(template):
+        template.remove(child)
+    template.text = None
+    template.append(wrapper)
+    return etree.tostring(root), pieces
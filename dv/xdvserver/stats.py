@@ -0,0 +1,102 @@
+import threading
+
+
+class Counters(object):
+    """A set of named counters that can be incremented from several threads
+    """
+    
+    def __init__(self, *names):
+        self.lock = threading.Lock()
+        self.values = dict([(name, 0) for name in names])
+    
+    def increment(self, name, amount=1):
+        self.lock.acquire()
+        try:
+            self.values[name] = self.values.get(name, 0) + amount
+        finally:
+            self.lock.release()
+    
+    def __getitem__(self, name):
+        return self.values.get(name, 0)
+    
+    def snapshot(self):
+        """Return a copy of the current values
+        """
+        self.lock.acquire()
+        try:
+            return dict(self.values)
+        finally:
+            self.lock.release()
+
+
+class Histogram(object):
+    """Keeps the count, total and maximum of values recorded from several
+    threads, and the last ``size`` values to estimate percentiles from
+    """
+    
+    def __init__(self, size=1024):
+        self.lock = threading.Lock()
+        self.size = size
+        self.samples = []
+        self.index = 0
+        self.count = 0
+        self.total = 0
+        self.max = 0
+    
+    def record(self, value):
+        self.lock.acquire()
+        try:
+            if len(self.samples) < self.size:
+                self.samples.append(value)
+            else:
+                self.samples[self.index] = value
+                self.index = (self.index + 1) % self.size
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+        finally:
+            self.lock.release()
+    
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            samples = sorted(self.samples)
+            stats = {
+                'count': self.count,
+                'total': self.total,
+                'max': self.max,
+            }
+        finally:
+            self.lock.release()
+        stats['mean'] = self.count and float(self.total) / self.count or 0
+        for percent in (50, 95, 99):
+            value = 0
+            if samples:
+                value = samples[min(len(samples) - 1, len(samples) * percent // 100)]
+            stats['p%d' % percent] = value
+        return stats
+
+
+class Histograms(object):
+    """A set of named histograms, created as values are first recorded
+    """
+    
+    def __init__(self, size=1024):
+        self.lock = threading.Lock()
+        self.size = size
+        self.histograms = {}
+    
+    def record(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            self.lock.acquire()
+            try:
+                histogram = self.histograms.setdefault(name, Histogram(self.size))
+            finally:
+                self.lock.release()
+        histogram.record(value)
+    
+    def snapshot(self):
+        return dict([(name, histogram.snapshot())
+                     for name, histogram in self.histograms.items()])
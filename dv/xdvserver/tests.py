@@ -1,5 +1,21 @@
+import os
+import shutil
+import json
+import gzip
+import tempfile
+import threading
 import unittest
-from dv.xdvserver.filter import XSLTMiddleware
+from StringIO import StringIO
+from lxml import etree
+from dv.xdvserver import batch, pool, warmcache
+from dv.xdvserver.filter import XSLTMiddleware, XDVMiddleware, bypass_pattern, themed_etag
+from dv.xdvserver.cache import LRUCache
+from dv.xdvserver.encoding import accepted_coding, compress
+from dv.xdvserver.includes import IncludeResolver, split_include
+from dv.xdvserver.multi import MultiThemeMiddleware
+from dv.xdvserver.resolver import CachingResolver
+from dv.xdvserver.serialize import serialize_chunks
+from dv.xdvserver.skeleton import split_theme
 from paste.fixture import TestApp
 
 def application(environ, start_response):
@@ -24,6 +40,22 @@ XHTML_IDENTITY = '''
 </xsl:stylesheet>
 '''
 
+RULES = '''<rules xmlns="http://namespaces.plone.org/xdv">
+    <copy theme="//div[@id='main']" content="//body/node()"/>
+</rules>
+'''
+
+THEME = '''<html><head><title>Theme</title></head>
+<body><div id="main">Placeholder</div><p>Theme footer</p></body></html>
+'''
+
+def write_file(directory, name, data):
+    path = os.path.join(directory, name)
+    f = open(path, 'w')
+    f.write(data)
+    f.close()
+    return path
+
 class TestXSLTMiddleware(unittest.TestCase):
 
     def broken_test_xhtml(self):
@@ -31,6 +63,853 @@ class TestXSLTMiddleware(unittest.TestCase):
         response = app.get('/')
         response.mustcontain('<br />')
 
+class TestLive(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.rules = write_file(self.directory, 'rules.xml', RULES)
+        self.theme = write_file(self.directory, 'theme.html', THEME)
+        self.middleware = XDVMiddleware(application, {}, rules=self.rules,
+                                        theme=self.theme, live=True)
+        self.compiled = []
+        compile_theme = self.middleware.compile_theme
+        def counting_compile_theme():
+            self.compiled.append(self.middleware.transform)
+            return compile_theme()
+        self.middleware.compile_theme = counting_compile_theme
+        self.app = TestApp(self.middleware)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_unchanged(self):
+        for i in range(3):
+            self.app.get('/').mustcontain('<div id="main">Hello world!')
+        self.assertEqual(len(self.compiled), 1)
+
+    def test_recompile_on_change(self):
+        self.app.get('/')
+        first = self.middleware.transform
+        write_file(self.directory, 'rules.xml', RULES.replace('main', 'none'))
+        stat = os.stat(self.rules)
+        os.utime(self.rules, (stat.st_atime, stat.st_mtime + 10))
+        for i in range(3):
+            response = self.app.get('/')
+        response.mustcontain('<div id="main">Placeholder</div>')
+        # compiled once more, and the new transform replaced the old one
+        self.assertEqual(self.compiled, [None, first])
+        self.failIf(self.middleware.transform is first)
+
+    def test_in_flight_after_recompile(self):
+        middleware = XDVMiddleware(application, {}, rules=self.rules, theme=self.theme,
+                                   live=True, max_transform_time=5, pool_size=1)
+        app = TestApp(middleware)
+        app.get('/')
+        first = middleware.transform
+        stat = os.stat(self.rules)
+        os.utime(self.rules, (stat.st_atime, stat.st_mtime + 10))
+        app.get('/')
+        self.failIf(middleware.transform is first)
+        # a request that got the old transform before it was swapped out
+        # still gets its page themed
+        TestApp(first).get('/').mustcontain('<div id="main">Hello world!')
+        self.assertEqual(first.transform_pool.counters.snapshot()['restarts'], 0)
+        middleware.release()
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.directory, 'cache')
+        self.rules = write_file(self.directory, 'rules.xml', RULES)
+        self.theme = write_file(self.directory, 'theme.html', THEME)
+        self.compiled = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def middleware(self):
+        middleware = XDVMiddleware(application, {}, rules=self.rules,
+                                   theme=self.theme, cache_dir=self.cache_dir)
+        compile_theme = middleware.compile_theme
+        def counting_compile_theme():
+            self.compiled += 1
+            return compile_theme()
+        middleware.compile_theme = counting_compile_theme
+        return middleware
+
+    def test_miss_then_hit(self):
+        TestApp(self.middleware()).get('/').mustcontain('<div id="main">Hello world!')
+        self.assertEqual(self.compiled, 1)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        # a new process loads the stored theme
+        TestApp(self.middleware()).get('/').mustcontain('<div id="main">Hello world!')
+        self.assertEqual(self.compiled, 1)
+
+    def test_changed_rules_miss(self):
+        middleware = self.middleware()
+        key = middleware.cache_key()
+        middleware.compiled_theme()
+        write_file(self.directory, 'rules.xml', RULES.replace('main', 'none'))
+        self.failIfEqual(middleware.cache_key(), key)
+        middleware.compiled_theme()
+        self.assertEqual(self.compiled, 2)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_corrupt_file(self):
+        middleware = self.middleware()
+        path = os.path.join(self.cache_dir, middleware.cache_key() + '.xsl')
+        os.makedirs(self.cache_dir)
+        write_file(self.cache_dir, os.path.basename(path), '<xsl:stylesheet')
+        TestApp(middleware).get('/').mustcontain('<div id="main">Hello world!')
+        self.assertEqual(self.compiled, 1)
+        etree.parse(path) # overwritten with the compiled theme
+
+    def test_warmcache_filter_names(self):
+        config = write_file(self.directory, 'server.ini', '''\
+[filter:theme]
+use = egg:dv.xdvserver#xdv
+
+[filter:other]
+use = egg:Paste#gzip
+
+[app:main]
+use = egg:Paste#static
+''')
+        self.assertEqual(warmcache.xdv_filter_names(config), ['theme'])
+
+class TestBypassPattern(unittest.TestCase):
+
+    def test_notheme_and_extensions(self):
+        pattern = bypass_pattern(['/emptypage', '^/plain$'])
+        self.assertEqual(pattern.match('/emptypage/foo').lastgroup, 'notheme')
+        self.assertEqual(pattern.match('/plain').lastgroup, 'notheme')
+        self.assertEqual(pattern.match('/files/report.pdf').lastgroup, 'extension')
+        self.failUnless(pattern.match('/front-page') is None)
+        self.failUnless(pattern.match('/plainer') is None)
+
+    def test_bypass_does_not_intercept(self):
+        def download(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/html')])
+            return iter(['chunk'] * 3)
+        middleware = XSLTMiddleware(app=download, global_conf=None,
+                                    xslt_source=XHTML_IDENTITY, ignore_paths=['/raw'])
+        app_iter = middleware({'PATH_INFO': '/raw/big'}, lambda status, headers: None)
+        self.assertEqual(list(app_iter), ['chunk'] * 3)
+        self.assertEqual(middleware.counters['notheme'], 1)
+
+
+class TestFeedParser(unittest.TestCase):
+
+    def test_parse_chunks(self):
+        closed = []
+        class Body(object):
+            def __iter__(self):
+                return iter(['<html><bo', 'dy>Hello <b', 'r></body></html>'])
+            def close(self):
+                closed.append(True)
+        def chunked(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/html')])
+            return Body()
+        app = TestApp(XSLTMiddleware(app=chunked, global_conf=None,
+                                     xslt_source=XHTML_IDENTITY, feed_parser=True))
+        response = app.get('/')
+        response.mustcontain('Hello')
+        self.assertEqual(closed, [True])
+
+
+class TestThreadTransforms(unittest.TestCase):
+
+    def test_one_transform_per_thread(self):
+        middleware = XSLTMiddleware(app=application, global_conf=None,
+                                    xslt_source=XHTML_IDENTITY)
+        transforms = []
+        def theme():
+            transforms.append((middleware.get_transform(), middleware.get_transform()))
+        threads = [threading.Thread(target=theme) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        (first, again), (other, _) = transforms
+        self.failUnless(first is again)
+        self.failIf(first is other)
+        self.assertEqual(middleware.transform_counters['built'], 2)
+
+    def test_element_tree(self):
+        # compile_theme and the cache directory give an element tree
+        tree = etree.ElementTree(etree.fromstring(XHTML_IDENTITY))
+        middleware = XSLTMiddleware(app=application, global_conf=None, xslt_tree=tree)
+        response = TestApp(middleware).get('/')
+        response.mustcontain('Hello world!')
+        self.assertEqual(middleware.transform_counters['built'], 1)
+
+
+class TestSerialize(unittest.TestCase):
+
+    def test_same_as_tostring(self):
+        from lxml import html
+        page = html.fromstring(u'''<html><head><title>Caf\xe9</title>
+<script>if (a < b) { c = "\xe9"; }</script> after script
+</head><body class="caf\xe9"><div id="main">Cr\xe8me <b>br\xfbl\xe9e</b> &amp; \u2603
+<p>\xe0 la <i>carte</i> &lt;menu&gt;</p> tail \xe9<br> na\xefve</div>
+\xc9t\xe9 <!-- comment --> fin</body></html>''').getroottree()
+        chunks = list(serialize_chunks(page, chunk_size=10))
+        self.failUnless(len(chunks) > 1)
+        self.assertEqual([type(chunk) for chunk in chunks], [str] * len(chunks))
+        self.assertEqual(''.join(chunks), html.tostring(page))
+
+
+class TestETags(unittest.TestCase):
+
+    def setUp(self):
+        def application(environ, start_response):
+            self.upstream_environ = environ.copy()
+            start_response('200 OK', [('Content-Type', 'text/html'), ('ETag', 'W/"abc"')])
+            return ['<html><body>Hello world!</body></html>']
+        self.middleware = XSLTMiddleware(app=application, global_conf=None,
+                                         xslt_source=XHTML_IDENTITY)
+        self.responses = []
+
+    def start_response(self, status, headers):
+        self.responses.append((status, dict([(k.lower(), v) for k, v in headers])))
+
+    def test_themed_etag(self):
+        self.middleware({'PATH_INFO': '/'}, self.start_response)
+        status, headers = self.responses[0]
+        self.assertEqual(headers['etag'], themed_etag('W/"abc"', self.middleware.version))
+        self.assertEqual(headers['etag'], 'W/"abc+xdv.%s"' % self.middleware.version)
+
+    def test_not_modified_without_transform(self):
+        etag = themed_etag('W/"abc"', self.middleware.version)
+        body = self.middleware({'PATH_INFO': '/', 'HTTP_IF_NONE_MATCH': etag},
+                               self.start_response)
+        self.assertEqual(self.upstream_environ['HTTP_IF_NONE_MATCH'], 'W/"abc"')
+        self.assertEqual(self.responses[0][0], '304 Not Modified')
+        self.assertEqual(list(body), [])
+
+    def test_stale_theme_version(self):
+        etag = themed_etag('W/"abc"', 'oldtheme')
+        self.middleware({'PATH_INFO': '/', 'HTTP_IF_NONE_MATCH': etag},
+                        self.start_response)
+        self.failIf('HTTP_IF_NONE_MATCH' in self.upstream_environ)
+        self.assertEqual(self.responses[0][0], '200 OK')
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.pages = ['<html><body>First</body></html>']
+        self.headers = [('Content-Type', 'text/html'),
+                        ('Last-Modified', 'Sat, 01 Jan 2011 00:00:00 GMT')]
+        def app(environ, start_response):
+            start_response('200 OK', list(self.headers))
+            return [self.pages[-1]]
+        self.middleware = XSLTMiddleware(app=app, global_conf=None,
+                                         xslt_source=XHTML_IDENTITY,
+                                         response_cache=LRUCache(max_size=10000))
+        self.app = TestApp(self.middleware)
+
+    def test_body_changes_under_same_last_modified(self):
+        self.app.get('/').mustcontain('First')
+        self.pages.append('<html><body>Second</body></html>')
+        self.app.get('/').mustcontain('Second')
+        self.app.get('/').mustcontain('Second')
+        self.assertEqual(self.middleware.response_cache.counters.snapshot()['hits'], 1)
+
+    def test_weak_etag_is_not_a_key(self):
+        self.headers.append(('ETag', 'W/"abc"'))
+        self.app.get('/').mustcontain('First')
+        self.pages.append('<html><body>Second</body></html>')
+        self.app.get('/').mustcontain('Second')
+
+    def test_strong_etag_is_a_key(self):
+        self.headers.append(('ETag', '"abc"'))
+        self.app.get('/').mustcontain('First')
+        self.pages.append('<html><body>Second</body></html>')
+        self.app.get('/').mustcontain('First')
+
+    def test_cookie_not_cached(self):
+        self.app.get('/', headers={'Cookie': '__ac=alice'}).mustcontain('First')
+        self.pages.append('<html><body>Second</body></html>')
+        self.app.get('/', headers={'Cookie': '__ac=bob'}).mustcontain('Second')
+        self.assertEqual(len(self.middleware.response_cache), 0)
+
+
+class TestEncoding(unittest.TestCase):
+
+    def test_accepted_coding(self):
+        self.assertEqual(accepted_coding('gzip, deflate'), 'gzip')
+        self.assertEqual(accepted_coding('deflate, gzip;q=0.5'), 'deflate')
+        self.assertEqual(accepted_coding('gzip;q=0'), None)
+        self.assertEqual(accepted_coding(None), None)
+
+    def test_gzip_upstream_and_output(self):
+        def compressed(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/html'),
+                                      ('Content-Encoding', 'gzip')])
+            return [compress('<html><body>Hello world!<br></body></html>', 'gzip', 6)]
+        app = TestApp(XSLTMiddleware(app=compressed, global_conf=None,
+                                     xslt_source=XHTML_IDENTITY,
+                                     compress_level=6, compress_min_size=0))
+        response = app.get('/')
+        self.failIf(response.header('content-encoding', None))
+        response.mustcontain('Hello world!')
+        
+        response = app.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.header('content-encoding'), 'gzip')
+        self.failUnless('Accept-Encoding' in response.header('vary'))
+        body = gzip.GzipFile(fileobj=StringIO(response.body)).read()
+        self.failUnless('Hello world!' in body)
+
+
+THEMES = '''
+[DEFAULT]
+rules = %(here)s/rules.xml
+
+[intranet]
+path = /intranet
+theme = intranet.html
+
+[client]
+host = client.com www.client.com
+theme = client.html
+
+[client-shop]
+host = client.com
+path = /shop /basket
+theme = shop.html
+'''
+
+class TestMultiTheme(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.write(fd, THEMES)
+        os.close(fd)
+        self.middleware = MultiThemeMiddleware(application, None,
+                                               themes=self.filename, css='false')
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_options(self):
+        intranet = self.middleware.middlewares['intranet']
+        self.assertEqual(intranet.theme, 'intranet.html')
+        self.assertEqual(intranet.rules, os.path.join(os.path.dirname(self.filename), 'rules.xml'))
+        self.assertEqual(intranet.css, False)
+
+    def test_select(self):
+        select = self.middleware.select
+        self.assertEqual(select({'HTTP_HOST': 'www.client.com:80', 'PATH_INFO': '/'}), 'client')
+        self.assertEqual(select({'HTTP_HOST': 'client.com', 'PATH_INFO': '/shop/cart'}), 'client-shop')
+        self.assertEqual(select({'HTTP_HOST': 'client.com', 'PATH_INFO': '/intranet'}), 'client')
+        self.assertEqual(select({'HTTP_HOST': 'other.com', 'PATH_INFO': '/intranet/x'}), 'intranet')
+        self.assertEqual(select({'HTTP_HOST': 'other.com', 'PATH_INFO': '/'}), None)
+
+
+class TestMultiThemeCompiled(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        write_file(self.directory, 'rules.xml', RULES)
+        write_file(self.directory, 'theme.html', THEME)
+        self.filename = write_file(self.directory, 'themes.cfg', '''
+[intranet]
+path = /intranet
+rules = %(here)s/rules.xml
+theme = %(here)s/theme.html
+
+[extranet]
+path = /extranet
+rules = %(here)s/rules.xml
+theme = %(here)s/theme.html
+''')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stats_path(self):
+        app = TestApp(MultiThemeMiddleware(application, None, themes=self.filename,
+                                           stats_path='/_xdv/stats'))
+        app.get('/intranet/').mustcontain('<div id="main">Hello world!')
+        stats = json.loads(app.get('/_xdv/stats').body)
+        intranet = stats['themes']['intranet']
+        self.assertEqual(intranet['requests'], 1)
+        self.assertEqual(intranet['compiled'], True)
+        self.assertEqual(intranet['filter']['requests']['themed'], 1)
+        self.assertEqual(stats['compiled']['entries'], 1)
+
+    def test_larger_than_max_size(self):
+        middleware = MultiThemeMiddleware(application, None, themes=self.filename,
+                                          max_size=10)
+        intranet = middleware.middlewares['intranet']
+        compiled = []
+        compile_theme = intranet.compile_theme
+        def counting_compile_theme():
+            compiled.append(1)
+            return compile_theme()
+        intranet.compile_theme = counting_compile_theme
+        app = TestApp(middleware)
+        app.get('/intranet/').mustcontain('<div id="main">Hello world!')
+        app.get('/intranet/').mustcontain('<div id="main">Hello world!')
+        # not kept compiled outside the bound
+        self.assertEqual(len(compiled), 2)
+        self.assertEqual(intranet.transform, None)
+        stats = middleware.stats()
+        self.assertEqual(stats['themes']['intranet']['oversized'], 2)
+        self.assertEqual(stats['compiled']['size'], 0)
+
+    def test_evicted_while_in_use(self):
+        middleware = MultiThemeMiddleware(application, None, themes=self.filename,
+                                          max_themes=1, max_transform_time=5)
+        intranet = middleware.middlewares['intranet']
+        app = TestApp(middleware)
+        app.get('/intranet/')
+        # a request looks the intranet theme up, then the extranet theme
+        # evicts it before that request runs it
+        transform = middleware.compiled.get('intranet')
+        app.get('/extranet/')
+        self.assertEqual(middleware.compiled.keys(), ['extranet'])
+        self.assertEqual(intranet.transform, None)
+        TestApp(transform).get('/intranet/').mustcontain('<div id="main">Hello world!')
+        # and it did not compile the theme again outside the cache
+        self.assertEqual(intranet.transform, None)
+        self.assertEqual(middleware.stats()['compiled']['entries'], 1)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=10)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        cache.get('a')
+        cache.set('c', 'cccc')
+        self.assertEqual(cache.keys(), ['c', 'a'])
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_too_large_and_expired(self):
+        cache = LRUCache(max_size=3)
+        self.assertEqual(cache.set('a', 'aaaa'), False)
+        self.assertEqual(cache.set('b', 'bb', ttl=-1), True)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+
+class TestIncludes(unittest.TestCase):
+
+    def fragment_app(self, environ, start_response):
+        self.requests.append(environ['PATH_INFO'])
+        start_response('200 OK', [('Content-Type', 'text/html'),
+                                  ('Cache-Control', self.cache_control)])
+        return ['<html><body><p id="a">A</p><p id="b">B</p></body></html>']
+
+    def setUp(self):
+        self.requests = []
+        self.cache_control = 'max-age=60'
+        self.resolver = IncludeResolver(self.fragment_app, cache_size=1000)
+        self.environ = {'wsgi.url_scheme': 'http', 'HTTP_HOST': 'example.com',
+                        'SCRIPT_NAME': '', 'PATH_INFO': '/page'}
+
+    def test_split_include(self):
+        self.assertEqual(split_include('/x?;filter_xpath=//p%5B@id=%27a%27%5D'),
+                         ('/x', "//p[@id='a']"))
+        self.assertEqual(split_include('/x'), ('/x', None))
+
+    def test_resolve_string(self):
+        body = ('<div><!--#include  virtual="/x?;filter_xpath=//p%5B@id=%27a%27%5D"-->'
+                '<esi:include src="/x?;filter_xpath=//p%5B@id=%27b%27%5D"></esi:include></div>')
+        self.assertEqual(self.resolver.resolve_string(self.environ, body),
+                         '<div><p id="a">A</p><p id="b">B</p></div>')
+        self.resolver.resolve_string(self.environ, body)
+        self.assertEqual(self.requests, ['/x'])
+        self.assertEqual(self.resolver.stats()['cache']['hits'], 1)
+
+    def test_credentials(self):
+        self.environ['HTTP_COOKIE'] = '__ac=alice'
+        body = '<div><esi:include src="/x"></esi:include></div>'
+        self.resolver.resolve_string(self.environ, body)
+        self.resolver.resolve_string(self.environ, body)
+        self.assertEqual(self.requests, ['/x', '/x'])
+        
+        # unless the fragment may be shared
+        self.cache_control = 'public, max-age=60'
+        self.resolver.resolve_string(self.environ, body)
+        self.resolver.resolve_string(self.environ, body)
+        self.assertEqual(self.requests, ['/x', '/x', '/x'])
+
+INCLUDE_RULES = '''<rules xmlns="http://namespaces.plone.org/xdv">
+    <copy theme="//div[@id='main']" content="//body/node()"/>
+    <append theme="//p" href="/nav.html" content="//ul[@id='nav']"/>
+</rules>
+'''
+
+class TestCompiledIncludes(unittest.TestCase):
+
+    def site(self, environ, start_response):
+        if environ['PATH_INFO'] == '/nav.html':
+            self.requests.append(environ['PATH_INFO'])
+            start_response('200 OK', [('Content-Type', 'text/html'),
+                                      ('Cache-Control', self.cache_control)])
+            return ['<html><body><ul id="nav"><li>%s</li></ul></body></html>' % self.nav]
+        start_response('200 OK', [('Content-Type', 'text/html'), ('ETag', '"page"')])
+        return ['<html><body>Hello world!<br></body></html>\n']
+
+    def setUp(self):
+        self.requests = []
+        self.cache_control = 'max-age=60'
+        self.nav = 'Home'
+        self.directory = tempfile.mkdtemp()
+        self.rules = write_file(self.directory, 'rules.xml', INCLUDE_RULES)
+        self.theme = write_file(self.directory, 'theme.html', THEME)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def middleware(self, **options):
+        return XDVMiddleware(self.site, {}, rules=self.rules, theme=self.theme,
+                             **options)
+
+    def test_resolve_compiled_includes(self):
+        for includemode in ('ssi', 'esi'):
+            for stream_output in (False, True):
+                app = TestApp(self.middleware(includemode=includemode,
+                                              resolve_includes=True,
+                                              stream_output=stream_output))
+                response = app.get('/')
+                response.mustcontain('<p>Theme footer<ul id="nav"><li>Home</li></ul></p>')
+                self.failIf('include' in response.body)
+        self.assertEqual(len(self.requests), 4)
+
+    def test_document_from_app(self):
+        for feed_parser in (False, True):
+            app = TestApp(self.middleware(includemode='document', resources_from_app=True,
+                                          read_network=True, feed_parser=feed_parser))
+            app.get('/').mustcontain('<p>Theme footer<ul id="nav"><li>Home</li></ul></p>')
+        self.assertEqual(self.requests, ['/nav.html', '/nav.html'])
+
+    def test_response_cache(self):
+        self.cache_control = 'no-cache'
+        middleware = self.middleware(includemode='esi', resolve_includes=True,
+                                     response_cache_size=10000)
+        app = TestApp(middleware)
+        response = app.get('/')
+        response.mustcontain('<li>Home</li>')
+        # the fragment is not covered by the upstream validator
+        self.assertEqual(response.header('etag', None), None)
+        self.nav = 'News'
+        response = app.get('/', headers={'If-None-Match': '"page"'})
+        self.assertEqual(response.status, 200)
+        response.mustcontain('<li>News</li>')
+        # the page itself came from the cache
+        self.assertEqual(middleware.response_cache.stats()['hits'], 1)
+
+
+DOCUMENT_XSLT = '''
+<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+    <xsl:template match="/">
+      <html><body><xsl:copy-of select="document('http://localhost/nav.xml')/ul"/></body></html>
+    </xsl:template>
+</xsl:stylesheet>
+'''
+
+class TestCachingResolver(unittest.TestCase):
+
+    def nav_app(self, environ, start_response):
+        if environ['PATH_INFO'] == '/nav.xml':
+            self.requests.append(environ['PATH_INFO'])
+            start_response('200 OK', [('Content-Type', 'text/xml'),
+                                      ('Cache-Control', self.cache_control)])
+            return ['<ul><li>Home</li></ul>']
+        return application(environ, start_response)
+
+    def setUp(self):
+        self.requests = []
+        self.cache_control = 'max-age=60'
+        self.resolver = CachingResolver(app=self.nav_app, cache_size=1000)
+        self.app = TestApp(XSLTMiddleware(self.nav_app, {}, xslt_source=DOCUMENT_XSLT,
+                                          read_network=True, resolver=self.resolver))
+
+    def test_document_from_app(self):
+        for i in range(2):
+            response = self.app.get('/')
+            self.failUnless('<ul><li>Home</li></ul>' in response.body)
+        self.assertEqual(self.requests, ['/nav.xml'])
+        self.assertEqual(self.resolver.stats()['hit_rate'], 0.5)
+
+    def test_credentials(self):
+        for i in range(2):
+            self.app.get('/', headers={'Authorization': 'Basic YWxpY2U6c2VjcmV0'})
+        self.assertEqual(self.requests, ['/nav.xml', '/nav.xml'])
+        
+        # unless the document may be shared
+        self.cache_control = 's-maxage=60'
+        for i in range(2):
+            self.app.get('/', headers={'Cookie': '__ac=alice'})
+        self.assertEqual(self.requests, ['/nav.xml', '/nav.xml', '/nav.xml'])
+
+class TestTimings(unittest.TestCase):
+
+    def test_timing_header_and_stats(self):
+        middleware = XSLTMiddleware(application, {}, xslt_source=XHTML_IDENTITY,
+                                    timing_header='Server-Timing',
+                                    stats_path='/_xdv/stats')
+        app = TestApp(middleware)
+        response = app.get('/')
+        timing = response.header('Server-Timing')
+        for stage in ('upstream', 'parse', 'transform', 'serialize', 'total'):
+            self.failUnless(stage + ';dur=' in timing)
+        app.get('/logo.png')
+
+        stats = json.loads(app.get('/_xdv/stats').body)
+        self.assertEqual(stats['requests']['themed'], 1)
+        self.assertEqual(stats['requests']['extension'], 1)
+        self.assertEqual(stats['timings']['transform']['count'], 1)
+        self.failUnless(stats['timings']['bytes_in']['max'] > 0)
+
+class TestProfile(unittest.TestCase):
+
+    def test_profile_every(self):
+        middleware = XSLTMiddleware(application, {}, xslt_source=XHTML_IDENTITY,
+                                    profile_every=2)
+        app = TestApp(middleware)
+        calls = []
+        for i in range(4):
+            app.get('/')
+            calls.append(dict([(t['match'], t['calls'])
+                               for t in middleware.stats()['profile']]))
+        self.assertEqual(calls[0], {})
+        self.failUnless(calls[1]['@*|node()'] > 0)
+        self.assertEqual(calls[2], calls[1])
+        self.assertEqual(calls[3]['@*|node()'], 2 * calls[1]['@*|node()'])
+
+    def test_compiled_origins(self):
+        directory = tempfile.mkdtemp()
+        try:
+            rules = write_file(directory, 'rules.xml', RULES.replace('</rules>',
+                '    <drop content="//br"/>\n</rules>'))
+            theme = write_file(directory, 'theme.html', THEME)
+            app = TestApp(XDVMiddleware(application, {}, rules=rules, theme=theme,
+                                        profile_every=1, stats_path='/_xdv/stats'))
+            app.get('/')
+            profile = json.loads(app.get('/_xdv/stats').body)['profile']
+        finally:
+            shutil.rmtree(directory)
+        origins = dict([(t['mode'], t['origin']) for t in profile
+                        if t['match'] in ('/', 'node()|@*')])
+        self.assertEqual(origins[''], 'initial-stage, apply-theme and final-stage passes')
+        self.failUnless('rules.xml:2 <copy theme="//div[@id=\'main\']"' in origins['apply-theme'])
+        self.failUnless('rules.xml:3 <drop content="//br"/>' in origins['initial-stage'])
+        self.assertEqual(origins['final-stage'], 'themed page copied through the final stage')
+
+class TestTransformPool(unittest.TestCase):
+
+    def setUp(self):
+        self.middleware = XSLTMiddleware(application, {}, xslt_source=XHTML_IDENTITY,
+                                         pool_size=1)
+        self.pool = self.middleware.transform_pool
+
+    def tearDown(self):
+        self.pool.pool.terminate()
+
+    def test_default_timeout(self):
+        self.assertEqual(self.pool.timeout, pool.POOL_TIMEOUT)
+
+    def test_theme_in_pool(self):
+        TestApp(self.middleware).get('/').mustcontain('Hello world!')
+        self.assertEqual(self.pool.counters.snapshot()['transforms'], 1)
+
+    def test_fallback(self):
+        # a pool that cannot take pages any more
+        self.pool.pool.terminate()
+        TestApp(self.middleware).get('/').mustcontain('Hello world!')
+        stats = self.pool.counters.snapshot()
+        self.assertEqual(stats['transforms'], 0)
+        self.assertEqual(stats['failures'], 1)
+
+
+class TestGuards(unittest.TestCase):
+
+    def request(self, middleware):
+        responses = []
+        def start_response(status, headers):
+            responses.append(dict([(k.lower(), v) for k, v in headers]))
+        body = ''.join(middleware({'PATH_INFO': '/'}, start_response))
+        return responses[0], body
+
+    def test_max_body_size(self):
+        middleware = XSLTMiddleware(application, {}, xslt_source=XHTML_IDENTITY,
+                                    max_body_size=10)
+        headers, body = self.request(middleware)
+        self.assertEqual(headers['x-xdv-degraded'], 'body-size')
+        self.assertEqual(body, '<html><body>Hello world!<br></body></html>\n')
+        self.assertEqual(middleware.counters['degraded_body_size'], 1)
+
+    def test_max_concurrent(self):
+        middleware = XSLTMiddleware(application, {}, xslt_source=XHTML_IDENTITY,
+                                    max_concurrent=1)
+        middleware.admission.acquire()
+        headers, body = self.request(middleware)
+        self.assertEqual(headers['x-xdv-degraded'], 'concurrency')
+        middleware.admission.release()
+        headers, body = self.request(middleware)
+        self.failIf('x-xdv-degraded' in headers)
+
+    def test_max_concurrent_streamed(self):
+        middleware = XSLTMiddleware(application, {}, xslt_source=XHTML_IDENTITY,
+                                    max_concurrent=1, stream_output=True)
+        start_response = lambda status, headers: None
+        # the first page holds the place until it has been sent
+        streamed = middleware({'PATH_INFO': '/'}, start_response)
+        headers, body = self.request(middleware)
+        self.assertEqual(headers['x-xdv-degraded'], 'concurrency')
+        self.failUnless('Hello world!' in ''.join(streamed))
+        headers, body = self.request(middleware)
+        self.failIf('x-xdv-degraded' in headers)
+        # or until it is closed
+        streamed = middleware({'PATH_INFO': '/'}, start_response)
+        streamed.close()
+        headers, body = self.request(middleware)
+        self.failIf('x-xdv-degraded' in headers)
+
+    def test_max_transform_time_streamed(self):
+        middleware = XSLTMiddleware(application, {}, xslt_source=XHTML_IDENTITY,
+                                    max_transform_time=5, stream_output=True)
+        body = middleware({'PATH_INFO': '/'}, lambda status, headers: None)
+        # serialized in the transform thread, within the time limit
+        self.failUnless(isinstance(body, list))
+        self.failUnless('Hello world!' in ''.join(body))
+        middleware.close()
+
+    def test_max_transform_time(self):
+        middleware = XSLTMiddleware(application, {}, xslt_source=XHTML_IDENTITY,
+                                    max_transform_time=0.1)
+        finished = threading.Event()
+        def slow_transform(environ, body):
+            finished.wait(5)
+            return 'themed'
+        middleware.apply_transform = slow_transform
+        headers, body = self.request(middleware)
+        self.assertEqual(headers['x-xdv-degraded'], 'transform-time')
+        self.failUnless('Hello world!' in body)
+        finished.set()
+        middleware.close()
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.output = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.source, 'news'))
+        for name in ('index.html', os.path.join('news', 'item.htm'), 'logo.png'):
+            f = open(os.path.join(self.source, name), 'w')
+            f.write('<html><body>Hello world!</body></html>')
+            f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+        shutil.rmtree(self.output)
+
+    def test_find_files(self):
+        self.assertEqual(batch.find_files(self.source, ['*.html', '*.htm']),
+                         ['index.html', os.path.join('news', 'item.htm')])
+
+    def test_theme_file(self):
+        pool._initialize(XHTML_IDENTITY, False)
+        relpath = os.path.join('news', 'item.htm')
+        job = (os.path.join(self.source, relpath), os.path.join(self.output, relpath), relpath)
+        name, ok, elapsed, size = batch.theme_file(job)
+        self.failUnless(ok)
+        self.assertEqual(size, os.path.getsize(os.path.join(self.output, relpath)))
+
+    def test_manifest(self):
+        self.assertEqual(batch.read_manifest(self.output), {})
+        manifest = {'index.html': {'source': batch.file_state(os.path.join(self.source, 'index.html')),
+                                   'version': 'abc'}}
+        batch.write_manifest(self.output, manifest)
+        self.assertEqual(batch.read_manifest(self.output), manifest)
+
+
+COMPILED_THEME = '''
+<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+    <xsl:template match="/"><xsl:apply-templates select="." mode="id1"/></xsl:template>
+    <xsl:template match="/" mode="id1"><html>
+        <head><title>Theme</title></head>
+        <body>
+            <div id="main">%s</div>
+            <p>Footer &amp; caf\xc3\xa9</p>
+        </body>
+    </html></xsl:template>
+    <xsl:template mode="id1" match="node()|@*">
+        <xsl:copy><xsl:apply-templates mode="id1" select="node()|@*"/></xsl:copy>
+    </xsl:template>
+</xsl:stylesheet>
+'''
+
+class TestSkeleton(unittest.TestCase):
+
+    def themed(self, region, skeleton, stylesheet=COMPILED_THEME, app=application):
+        middleware = XSLTMiddleware(app, {}, xslt_source=stylesheet % region,
+                                    skeleton=skeleton)
+        return middleware, TestApp(middleware).get('/').body
+
+    def test_splice(self):
+        region = '<xsl:apply-templates mode="id1" select="//body/node()"/>'
+        self.assertEqual(len(split_theme(COMPILED_THEME % region).pieces), 2)
+        middleware, spliced = self.themed(region, True)
+        self.failUnless(middleware.skeleton is not None)
+        self.failUnless('<div id="main">Hello world!<br></div>' in spliced)
+        self.assertEqual(spliced, self.themed(region, False)[1])
+
+    def test_extra_namespace(self):
+        # declarations the stylesheet does not exclude are written onto the
+        # elements of the regions stylesheet
+        stylesheet = COMPILED_THEME.replace(
+            'xmlns:xsl=', 'xmlns:css="http://namespaces.plone.org/xdv+css" xmlns:xsl=')
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8')])
+            return ['<html><body>Caf\xc3\xa9 &amp; &lt;b&gt;<br>x</body></html>']
+        region = '<xsl:apply-templates mode="id1" select="//body/node()"/>'
+        self.failUnless(split_theme(stylesheet % region) is not None)
+        middleware, spliced = self.themed(region, True, stylesheet, app)
+        self.failUnless(middleware.skeleton is not None)
+        self.assertEqual(spliced, self.themed(region, False, stylesheet, app)[1])
+
+    def test_compiled_rules(self):
+        # the rule sets of the benchmark, which xdv compiles into passes
+        # before and after the theme
+        directory = os.path.join(os.path.dirname(__file__), 'benchmark')
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8')])
+            return ['<html><head><title>Caf\xc3\xa9</title><script>a < b && c</script></head>'
+                    '<body><div id="content"><pre>a\r\nb</pre><div class="documentActions">'
+                    'x</div></div><div id="portal-column-one"><b>y</b></div></body></html>']
+        for rules in ('rules-xpath.xml', 'rules-css.xml', 'rules-heavy.xml'):
+            themed = []
+            for skeleton in (False, True):
+                middleware = XDVMiddleware(app, {}, rules=os.path.join(directory, rules),
+                                           theme=os.path.join(directory, 'theme.html'),
+                                           skeleton=skeleton)
+                transform = middleware.current_transform({})
+                self.assertEqual(transform.skeleton is not None, skeleton)
+                themed.append(TestApp(middleware).get('/').body)
+            self.failUnless('<div id="content"><pre>a\nb</pre></div>' in themed[1])
+            self.failUnless('<script>a < b && c</script>' in themed[1])
+            self.assertEqual(themed[1], themed[0])
+
+    def test_fallback(self):
+        for region in ('<xsl:if test="//br">Hello</xsl:if>',
+                       '<xsl:apply-templates mode="id1" select="//body/@class"/>',
+                       '<span title="{//title}"/>'):
+            self.assertEqual(split_theme(COMPILED_THEME % region), None)
+            middleware, themed = self.themed(region, True)
+            self.assertEqual(middleware.skeleton, None)
+            self.assertEqual(themed, self.themed(region, False)[1])
+
 
 def test_suite():
     return unittest.defaultTestLoader.loadTestsFromName(__name__)
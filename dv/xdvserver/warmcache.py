@@ -0,0 +1,57 @@
+"""\
+Usage: %prog [options] CONFIG_FILE
+
+  Compile the themes of the xdv filters in a Paste Deploy CONFIG_FILE into
+  their ``cache_dir``, so that server processes started afterwards load the
+  compiled themes instead of compiling them.\
+"""
+usage = __doc__
+
+import os.path
+import ConfigParser
+
+from optparse import OptionParser
+from paste.deploy import loadfilter
+
+from dv.xdvserver.filter import XDVMiddleware
+
+
+def xdv_filter_names(config_file):
+    """Return the names of the filters in ``config_file`` using this package
+    """
+    parser = ConfigParser.RawConfigParser()
+    parser.read(config_file)
+    names = []
+    for section in parser.sections():
+        if not section.startswith('filter:'):
+            continue
+        if parser.has_option(section, 'use') and 'dv.xdvserver' in parser.get(section, 'use'):
+            names.append(section[len('filter:'):])
+    return names
+
+
+def main():
+    """Called from console script
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option("-n", "--name", action="append",
+                      help="Name of a filter to warm (default: all xdv filters)",
+                      dest="names", default=[])
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Wrong number of arguments.")
+    
+    config_file = os.path.abspath(args[0])
+    names = options.names or xdv_filter_names(config_file)
+    for name in names:
+        middleware = loadfilter('config:%s' % config_file, name=name)(None)
+        if not isinstance(middleware, XDVMiddleware):
+            continue
+        if not middleware.cache_dir:
+            print("%s: no cache_dir configured, skipping" % name)
+            continue
+        middleware.compiled_theme()
+        print("%s: %s" % (name, os.path.join(middleware.cache_dir, middleware.cache_key() + '.xsl')))
+
+if __name__ == '__main__':
+    main()
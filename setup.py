@@ -34,5 +34,11 @@ setup(name='dv.xdvserver',
       [paste.filter_app_factory]
       xslt = dv.xdvserver.filter:XSLTMiddleware
       xdv = dv.xdvserver.filter:XDVMiddleware
+      multi = dv.xdvserver.multi:MultiThemeMiddleware
+
+      [console_scripts]
+      xdvserver-warmcache = dv.xdvserver.warmcache:main
+      xdvserver-benchmark = dv.xdvserver.benchmark.run:main
+      xdvserver-theme = dv.xdvserver.batch:main
       """,
       )